@@ -1,20 +1,47 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import psycopg
+from psycopg import sql
+from psycopg.types.json import Jsonb
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
 import logging
-from datetime import datetime
+import sys
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import importlib
+import time
+import json
+import hashlib
+import copy
+import gzip
+import zipfile
+from datetime import datetime, date, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
 import io
 import uuid
+import socket
 import re
+import openpyxl
+import xlsxwriter
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow есть в requirements.txt; в окружении без него экспорт в Parquet просто недоступен
+    pa = None
 from docx import Document
 from docx.shared import Inches
 import pdfkit
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 import base64
 from docx.enum.style import WD_STYLE_TYPE
 from docx.shared import Pt
+from docx.oxml.ns import qn
 from docx import Document
 
 # Настройка логирования
@@ -60,26 +87,54 @@ def clear_logs_daily():
             print(f"Error clearing log {log_file}: {e}")
             
 # Настройка подключения к PostgreSQL
+DB_CONNECTION_PARAMS = {
+    "dbname": "meta_base",
+    "user": "postgres",
+    "password": "1234",
+    "host": "localhost",
+    "port": "5432",
+    "sslmode": "require",  # Для облачной базы, если требуется
+}
+
+# Параметры пула соединений (можно переопределить переменными окружения)
+DB_POOL_MIN_SIZE = int(os.environ.get("PHARMA_DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.environ.get("PHARMA_DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("PHARMA_DB_POOL_TIMEOUT", 10))  # Ожидание свободного соединения, сек
+DB_POOL_MAX_IDLE = float(os.environ.get("PHARMA_DB_POOL_MAX_IDLE", 300))  # Закрытие простаивающих соединений сверх min_size, сек
+DB_POOL_MAX_LIFETIME = float(os.environ.get("PHARMA_DB_POOL_MAX_LIFETIME", 3600))  # Плановое пересоздание соединений, сек
+DB_CONNECT_TIMEOUT = int(os.environ.get("PHARMA_DB_CONNECT_TIMEOUT", 5))
+
+def get_db_conninfo():
+    return make_conninfo(**DB_CONNECTION_PARAMS, connect_timeout=DB_CONNECT_TIMEOUT)
+
+@st.cache_resource
+def get_db_pool():
+    # Один пул на процесс сервера Streamlit, общий для всех сессий и перезапусков скрипта
+    return ConnectionPool(
+        conninfo=get_db_conninfo(),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        check=ConnectionPool.check_connection,  # Проверка соединения перед выдачей из пула
+        name="pharma_meta_pool",
+        open=True,
+    )
+
 def get_db_connection():
     try:
-        conn = psycopg.connect(
-            dbname="meta_base",
-            user="postgres",
-            password="1234",
-            host="localhost",
-            port="5432",
-            sslmode="require"  # Для облачной базы, если требуется
-        )
-        return conn
-    except psycopg.Error as e:
+        return get_db_pool().getconn()
+    except psycopg.Error as e:  # PoolTimeout тоже наследуется от psycopg.Error
         st.error(f"Ошибка подключения к базе данных: {e}")
         return None
+
+def release_db_connection(conn):
+    # Соединение возвращается в пул; незавершённая транзакция откатывается пулом
+    get_db_pool().putconn(conn)
         
-def init_db():
-    conn = get_db_connection()
-    if conn is None:
-        return
-    c = conn.cursor()
+# Миграции схемы: каждая миграция применяется один раз, номер версии записывается в schema_migrations
+def _migration_0001_initial_schema(c):
     # Создание таблицы companies
     c.execute('''CREATE TABLE IF NOT EXISTS companies (
         id SERIAL PRIMARY KEY,
@@ -169,41 +224,635 @@ def init_db():
     if not c.fetchone():
         c.execute("ALTER TABLE medicines ADD COLUMN atc_code VARCHAR(20)")
 
-    conn.commit()
-    conn.close()
+def _migration_0002_lookup_indexes(c):
+    # Внешние ключи: проверки зависимостей при удалении и соединения по id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_operations_medicine_id ON operations (medicine_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_operations_location_id ON operations (location_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medicines_owned_by ON medicines (owned_by)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_locations_owned_by ON locations (owned_by)")
+    # Проверки дубликатов в формах редактирования
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medicines_gtin_sku ON medicines (gtin, sku)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_companies_gln_name_full ON companies (gln, name_full)")
+    # Фильтры и графики по датам
+    c.execute("CREATE INDEX IF NOT EXISTS idx_operations_operation_date ON operations (operation_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medicines_expiration_date ON medicines (expiration_date)")
+    # users.login уже покрыт индексом ограничения UNIQUE
 
-# Функции получения данных
-def get_medications():
+CHANGE_NOTIFY_CHANNEL = "pharma_changes"
+CACHED_TABLES = ("companies", "medicines", "locations", "operations")
+JOB_TABLES = ("expiry_alerts",)  # Заполняются фоновыми задачами, уведомление отправляет сама задача
+
+def _migration_0003_change_notify_triggers(c):
+    # Каждое изменение таблицы публикует NOTIFY с её именем — для сброса кэша на всех репликах
+    create_notify_function(c)
+    for table in CACHED_TABLES:
+        create_notify_triggers(c, table)
+
+def create_notify_function(c):
+    # Одно уведомление на оператор, а не на строку: кэшу нужна только таблица. Одинаковые уведомления
+    # одной транзакции PostgreSQL объединяет, поэтому импорт или восстановление дают по одному NOTIFY на таблицу.
+    c.execute(f'''CREATE OR REPLACE FUNCTION pharma_notify_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANGE_NOTIFY_CHANNEL}', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP)::text);
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql''')
+
+def create_notify_triggers(c, table):
+    c.execute(f"DROP TRIGGER IF EXISTS {table}_notify_change ON {table}")
+    c.execute(f"CREATE TRIGGER {table}_notify_change AFTER INSERT OR UPDATE OR DELETE ON {table} FOR EACH STATEMENT EXECUTE FUNCTION pharma_notify_change()")
+    c.execute(f"DROP TRIGGER IF EXISTS {table}_notify_truncate ON {table}")
+    c.execute(f"CREATE TRIGGER {table}_notify_truncate AFTER TRUNCATE ON {table} FOR EACH STATEMENT EXECUTE FUNCTION pharma_notify_change()")
+
+def _migration_0004_import_progress(c):
+    # Состояние потокового импорта: позволяет продолжить загрузку файла с последней сохранённой порции
+    c.execute('''CREATE TABLE IF NOT EXISTS import_progress (
+        import_key VARCHAR(64) PRIMARY KEY,
+        file_name VARCHAR(200),
+        table_name VARCHAR(50),
+        chunks_done INTEGER DEFAULT 0,
+        rows_done BIGINT DEFAULT 0,
+        inserted BIGINT DEFAULT 0,
+        skipped BIGINT DEFAULT 0,
+        completed BOOLEAN DEFAULT FALSE,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+def _migration_0005_import_rejected_rows(c):
+    c.execute("ALTER TABLE import_progress ADD COLUMN IF NOT EXISTS rejected BIGINT DEFAULT 0")
+
+# Поля, по которым ищется подстрока (страница фильтрации и поиск по каталогу); индексируются триграммами
+SEARCH_COLUMNS = {
+    "medicines": ["name", "active_ingredient"],
+    "companies": ["name_short", "name_full", "address"],
+    "locations": ["name_short", "name_full", "address"],
+}
+
+def _migration_0006_trigram_search_indexes(c):
+    # GIN-индексы pg_trgm ускоряют ILIKE '%...%' и поиск по сходству
+    c.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, columns in SEARCH_COLUMNS.items():
+        for column in columns:
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)")
+
+# Представления с готовыми к показу строками: названия связанных записей подставляются соединением в базе
+DISPLAY_VIEWS = {"medicines": "medicines_display", "companies": "companies", "locations": "locations_display", "operations": "operations_display"}
+VIEW_DEPENDENCIES = {
+    "medicines_display": ("medicines", "companies"),
+    "companies": ("companies",),
+    "locations_display": ("locations", "companies"),
+    "operations_display": ("operations", "medicines", "locations"),
+}
+
+def _migration_0007_display_views(c):
+    c.execute('''CREATE OR REPLACE VIEW medicines_display AS
+        SELECT m.id, m.owned_by, c.name_full AS owned_by_name, m.name, m.gtin, m.sku, m.atc_code, m.market, m.shared,
+               m.batch_number, m.expiration_date, m.dosage_form, m.active_ingredient, m.package_size, m.created_date
+        FROM medicines m
+        LEFT JOIN companies c ON c.id = m.owned_by''')
+    c.execute('''CREATE OR REPLACE VIEW locations_display AS
+        SELECT l.id, l.owned_by, c.name_full AS owned_by_name, l.gln, l.country, l.address, l.role,
+               l.name_short, l.name_full, l.created_date
+        FROM locations l
+        LEFT JOIN companies c ON c.id = l.owned_by''')
+    c.execute('''CREATE OR REPLACE VIEW operations_display AS
+        SELECT o.id, o.medicine_id, m.name AS medicine_name, o.location_id, l.name_short AS location_name,
+               o.operation_type, o.operation_date, o.quantity, o.created_date
+        FROM operations o
+        LEFT JOIN medicines m ON m.id = o.medicine_id
+        LEFT JOIN locations l ON l.id = o.location_id''')
+
+# Дневные итоги операций: (день, тип, препарат, локация) -> сумма количества и число операций.
+# NULL в ключе заменяется на '' / 0, чтобы ключ годился для первичного ключа и ON CONFLICT.
+OPERATIONS_ROLLUP_TABLE = "operations_daily_rollup"
+OPERATIONS_ROLLUP_SELECT = '''SELECT operation_date::date, COALESCE(operation_type, ''), COALESCE(medicine_id, 0), COALESCE(location_id, 0),
+               {sign}COALESCE(sum(quantity), 0), {sign}count(*)
+        FROM {source} WHERE operation_date IS NOT NULL
+        GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4'''
+
+def operations_rollup_upsert(source, sign=""):
+    # Строки вставляются в порядке ключа, чтобы параллельные транзакции блокировали итоги в одном порядке
+    return f'''INSERT INTO {OPERATIONS_ROLLUP_TABLE} AS r (day, operation_type, medicine_id, location_id, quantity_total, operation_count)
+        {OPERATIONS_ROLLUP_SELECT.format(sign=sign, source=source)}
+        ON CONFLICT (day, operation_type, medicine_id, location_id) DO UPDATE
+        SET quantity_total = r.quantity_total + EXCLUDED.quantity_total,
+            operation_count = r.operation_count + EXCLUDED.operation_count'''
+
+def _migration_0008_operations_daily_rollup(c):
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {OPERATIONS_ROLLUP_TABLE} (
+        day DATE NOT NULL,
+        operation_type VARCHAR(50) NOT NULL DEFAULT '',
+        medicine_id INTEGER NOT NULL DEFAULT 0,
+        location_id INTEGER NOT NULL DEFAULT 0,
+        quantity_total BIGINT NOT NULL DEFAULT 0,
+        operation_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, operation_type, medicine_id, location_id)
+    )''')
+    # Триггеры уровня оператора с таблицами переходов: один пересчёт на INSERT ... SELECT импорта, а не на каждую строку
+    c.execute(f'''CREATE OR REPLACE FUNCTION pharma_rollup_operations() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM {OPERATIONS_ROLLUP_TABLE};
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {operations_rollup_upsert("old_rows", "-")};
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {operations_rollup_upsert("new_rows")};
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {OPERATIONS_ROLLUP_TABLE} r
+                USING (SELECT DISTINCT operation_date::date AS day, COALESCE(operation_type, '') AS operation_type,
+                              COALESCE(medicine_id, 0) AS medicine_id, COALESCE(location_id, 0) AS location_id
+                       FROM old_rows WHERE operation_date IS NOT NULL) k
+                WHERE r.day = k.day AND r.operation_type = k.operation_type AND r.medicine_id = k.medicine_id
+                  AND r.location_id = k.location_id AND r.operation_count = 0;
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql''')
+    create_transition_triggers(c, "operations", "rollup", "pharma_rollup_operations")
+    rebuild_operation_rollups(c)
+
+def create_transition_triggers(c, table, name, function):
+    # Таблицы переходов допускаются только у триггеров с одним событием, поэтому триггеров три (и один на TRUNCATE)
+    c.execute(f"DROP TRIGGER IF EXISTS {table}_{name}_insert ON {table}")
+    c.execute(f"CREATE TRIGGER {table}_{name}_insert AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {function}()")
+    c.execute(f"DROP TRIGGER IF EXISTS {table}_{name}_update ON {table}")
+    c.execute(f"CREATE TRIGGER {table}_{name}_update AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {function}()")
+    c.execute(f"DROP TRIGGER IF EXISTS {table}_{name}_delete ON {table}")
+    c.execute(f"CREATE TRIGGER {table}_{name}_delete AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {function}()")
+    c.execute(f"DROP TRIGGER IF EXISTS {table}_{name}_truncate ON {table}")
+    c.execute(f"CREATE TRIGGER {table}_{name}_truncate AFTER TRUNCATE ON {table} FOR EACH STATEMENT EXECUTE FUNCTION {function}()")
+
+def rebuild_operation_rollups(c):
+    # Полный пересчёт итогов; блокировка SHARE не даёт писать в operations, пока итоги пересобираются
+    c.execute("LOCK TABLE operations IN SHARE MODE")
+    c.execute(f"DELETE FROM {OPERATIONS_ROLLUP_TABLE}")
+    c.execute(f'''INSERT INTO {OPERATIONS_ROLLUP_TABLE} (day, operation_type, medicine_id, location_id, quantity_total, operation_count)
+        {OPERATIONS_ROLLUP_SELECT.format(sign="", source="operations")}''')
+
+# Остатки по (препарат, локация): знак операции определяет, увеличивает она остаток или уменьшает.
+# Типы, которых нет в таблице знаков (Агрегация, Дистрибьютор), на остаток не влияют.
+# Перемещение тоже не учитывается: в операции есть только локация назначения, списать количество с источника нельзя.
+STOCK_OPERATION_SIGNS = {"Поставка": 1, "Производство": 1, "Списание": -1}
+
+def stock_balance_upsert(source, sign=""):
+    return f'''INSERT INTO stock_balances AS b (medicine_id, location_id, quantity)
+        SELECT COALESCE(o.medicine_id, 0), COALESCE(o.location_id, 0), {sign}COALESCE(sum(s.sign * o.quantity), 0)
+        FROM {source} o JOIN stock_operation_signs s ON s.operation_type = o.operation_type
+        GROUP BY 1, 2 ORDER BY 1, 2
+        ON CONFLICT (medicine_id, location_id) DO UPDATE SET quantity = b.quantity + EXCLUDED.quantity'''
+
+def _migration_0009_stock_balances(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_operation_signs (
+        operation_type VARCHAR(50) PRIMARY KEY,
+        sign SMALLINT NOT NULL
+    )''')
+    for operation_type, sign in STOCK_OPERATION_SIGNS.items():
+        c.execute("INSERT INTO stock_operation_signs (operation_type, sign) VALUES (%s, %s) ON CONFLICT DO NOTHING", (operation_type, sign))
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_balances (
+        medicine_id INTEGER NOT NULL DEFAULT 0,
+        location_id INTEGER NOT NULL DEFAULT 0,
+        quantity BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (medicine_id, location_id)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_balances_location_id ON stock_balances (location_id)")
+    # Снимок — остатки на конец дня snapshot_date; запрос «на дату» берёт ближайший снимок и добавляет дневные итоги после него
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_snapshots (
+        snapshot_date DATE NOT NULL,
+        medicine_id INTEGER NOT NULL DEFAULT 0,
+        location_id INTEGER NOT NULL DEFAULT 0,
+        quantity BIGINT NOT NULL,
+        PRIMARY KEY (snapshot_date, medicine_id, location_id)
+    )''')
+    # Операция задним числом делает снимки начиная с её даты устаревшими — они удаляются
+    c.execute(f'''CREATE OR REPLACE FUNCTION pharma_stock_operations() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM stock_balances;
+                DELETE FROM stock_snapshots;
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {stock_balance_upsert("old_rows", "-")};
+                DELETE FROM stock_snapshots WHERE snapshot_date >= (SELECT min(operation_date)::date FROM old_rows);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {stock_balance_upsert("new_rows")};
+                DELETE FROM stock_snapshots WHERE snapshot_date >= (SELECT min(operation_date)::date FROM new_rows);
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql''')
+    create_transition_triggers(c, "operations", "stock", "pharma_stock_operations")
+    rebuild_stock_balances(c)
+
+def rebuild_stock_balances(c):
+    # Нужен после изменения stock_operation_signs; снимки пересчитываются заново командой stock-snapshot
+    c.execute("LOCK TABLE operations IN SHARE MODE")
+    c.execute("DELETE FROM stock_balances")
+    c.execute("DELETE FROM stock_snapshots")
+    c.execute('''INSERT INTO stock_balances (medicine_id, location_id, quantity)
+        SELECT COALESCE(o.medicine_id, 0), COALESCE(o.location_id, 0), COALESCE(sum(s.sign * o.quantity), 0)
+        FROM operations o JOIN stock_operation_signs s ON s.operation_type = o.operation_type
+        GROUP BY 1, 2''')
+
+def _migration_0010_traceability_indexes(c):
+    # Поиск препаратов по серии и выборка операций препарата в хронологическом порядке без сортировки
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medicines_batch_number ON medicines (batch_number)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_operations_medicine_date ON operations (medicine_id, operation_date, id)")
+
+def _migration_0011_expiry_alerts(c):
+    # Список истекающих препаратов по компаниям и локациям; пересобирается фоновой задачей раз в сутки
+    c.execute('''CREATE TABLE IF NOT EXISTS expiry_alerts (
+        generated_on DATE NOT NULL,
+        medicine_id INTEGER NOT NULL,
+        company_id INTEGER,
+        location_id INTEGER,
+        expiration_date DATE NOT NULL,
+        days_left INTEGER NOT NULL,
+        quantity BIGINT
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expiry_alerts_company_id ON expiry_alerts (company_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expiry_alerts_location_id ON expiry_alerts (location_id)")
+
+def _migration_0012_jobs(c):
+    # Очередь фоновых задач (импорт, экспорт, отчёты); состояние читается страницей «Задачи»
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id SERIAL PRIMARY KEY,
+        kind VARCHAR(20) NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'queued',
+        params JSONB NOT NULL DEFAULT '{}',
+        progress REAL NOT NULL DEFAULT 0,
+        message TEXT,
+        result_path VARCHAR(500),
+        result_name VARCHAR(200),
+        created_by VARCHAR(20),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_by_created_at ON jobs (created_by, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+
+def _migration_0013_job_workers(c):
+    # Процессы, выполняющие задачи, регулярно отмечаются в job_workers; задачи процесса без отметок считаются прерванными
+    c.execute('''CREATE TABLE IF NOT EXISTS job_workers (
+        owner VARCHAR(100) PRIMARY KEY,
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        heartbeat_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS owner VARCHAR(100)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs (owner)")
+
+def _migration_0014_exclude_transfers_from_stock(c):
+    # Перемещение учитывалось только приходом в локацию назначения и завышало остатки; остатки и список истекающих пересчитываются
+    c.execute("DELETE FROM stock_operation_signs WHERE operation_type = 'Перемещение'")
+    rebuild_stock_balances(c)
+    generate_expiry_alerts(c, date.today())
+
+def _migration_0015_statement_notify_triggers(c):
+    # Построчные NOTIFY заменяются уведомлением на оператор
+    create_notify_function(c)
+    for table in CACHED_TABLES:
+        create_notify_triggers(c, table)
+
+def view_sort_index_statements(table, concurrently=False):
+    # Индексы по выражению сортировки и id: страница читается диапазоном индекса, без сортировки всей таблицы
+    return [f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS idx_{table}_{column}_sort "
+            f"ON {table} (({view_sort_expression(column)}), id)"
+            for column in VIEW_SORT_COLUMNS[table] if column != 'id' and column not in VIEW_RAW_SORT_COLUMNS]
+
+def _migration_0016_view_sort_indexes(c):
+    # Здесь только небольшие справочники; индексы больших таблиц строит команда create-sort-indexes без блокировки записи
+    for table in VIEW_SORT_INDEX_MIGRATION_TABLES:
+        for statement in view_sort_index_statements(table):
+            c.execute(statement)
+
+def _migration_0017_drop_unused_sort_indexes(c):
+    # Первая версия миграции 16 создавала индекс для каждого столбца просмотра; лишние удаляются
+    for table, columns in VIEW_DISPLAY_COLUMNS.items():
+        for column in columns:
+            if column not in VIEW_SORT_COLUMNS[table] or column in VIEW_RAW_SORT_COLUMNS:
+                c.execute(f"DROP INDEX IF EXISTS idx_{table}_{column}_sort")
+
+MIGRATIONS = [
+    (1, "Базовая схема: companies, medicines, locations, operations, users", _migration_0001_initial_schema),
+    (2, "Индексы по внешним ключам и полям поиска", _migration_0002_lookup_indexes),
+    (3, "Триггеры NOTIFY для сброса кэша на всех репликах", _migration_0003_change_notify_triggers),
+    (4, "Таблица прогресса потокового импорта", _migration_0004_import_progress),
+    (5, "Счётчик отклонённых при импорте строк", _migration_0005_import_rejected_rows),
+    (6, "Триграммные индексы для поиска по подстроке", _migration_0006_trigram_search_indexes),
+    (7, "Представления для просмотра, фильтрации и экспорта", _migration_0007_display_views),
+    (8, "Дневные итоги операций с инкрементальным обновлением триггерами", _migration_0008_operations_daily_rollup),
+    (9, "Остатки по препаратам и локациям, снимки остатков", _migration_0009_stock_balances),
+    (10, "Индексы для прослеживания серий", _migration_0010_traceability_indexes),
+    (11, "Список истекающих препаратов", _migration_0011_expiry_alerts),
+    (12, "Очередь фоновых задач", _migration_0012_jobs),
+    (13, "Владельцы фоновых задач и отметки о работе процессов", _migration_0013_job_workers),
+    (14, "Перемещения не меняют остатки", _migration_0014_exclude_transfers_from_stock),
+    (15, "Уведомления об изменениях — по одному на оператор", _migration_0015_statement_notify_triggers),
+    (16, "Индексы для постраничного просмотра с сортировкой", _migration_0016_view_sort_indexes),
+    (17, "Удаление неиспользуемых индексов сортировки", _migration_0017_drop_unused_sort_indexes),
+]
+
+SCHEMA_MIGRATIONS_LOCK_ID = 7305001  # Ключ advisory-блокировки, чтобы реплики не применяли миграции одновременно
+
+def get_schema_version(c):
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return c.fetchone()[0]
+
+def init_db():
     conn = get_db_connection()
     if conn is None:
+        return False
+    c = conn.cursor()
+    try:
+        c.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR(200),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        conn.commit()
+        current_version = get_schema_version(c)
+        for version, description, apply_migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+            apply_migration(c)
+            c.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+            conn.commit()
+            log_action("Applied schema migration", f"Version: {version} - {description}")
+        return True
+    except psycopg.Error as e:
+        conn.rollback()
+        st.error(f"Ошибка миграции схемы базы данных: {e}")
+        return False
+    finally:
+        try:
+            c.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+            conn.commit()
+        except psycopg.Error:
+            pass
+        release_db_connection(conn)
+
+@st.cache_resource
+def ensure_schema():
+    # Миграции выполняются один раз на процесс сервера, а не при каждом перезапуске скрипта.
+    # Секции будущих месяцев создаёт фоновая проверка start_operation_partitions_job
+    return init_db()
+
+# Секционирование operations по месяцам operation_date. Перевод существующей таблицы выполняется
+# явной командой partition-operations (переписывает всю таблицу), а не автоматической миграцией.
+# Первичного ключа у секционированной таблицы нет: уникальный индекс обязан включать operation_date,
+# а он может быть NULL; вместо него используется обычный индекс по id.
+OPERATIONS_DEFAULT_PARTITION = "operations_default"
+OPERATIONS_PARTITION_MONTHS_AHEAD = int(os.environ.get("PHARMA_PARTITION_MONTHS_AHEAD", 3))
+OPERATIONS_PARTITION_CHECK_SECONDS = 3600
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+def next_month(day):
+    return (month_start(day) + timedelta(days=32)).replace(day=1)
+
+def operations_partition_name(month):
+    return f"operations_{month:%Y_%m}"
+
+def is_operations_partitioned(c):
+    c.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'operations'::regclass)")
+    return c.fetchone()[0]
+
+def create_operations_triggers(c):
+    # Все триггеры operations в одном месте: их нужно пересоздавать после перевода таблицы в секционированную
+    create_notify_triggers(c, "operations")
+    create_transition_triggers(c, "operations", "rollup", "pharma_rollup_operations")
+    create_transition_triggers(c, "operations", "stock", "pharma_stock_operations")
+
+def create_operations_partition(c, month):
+    month = month_start(month)
+    name = operations_partition_name(month)
+    c.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    if c.fetchone()[0]:
+        return False
+    # Строки этого месяца, попавшие в секцию по умолчанию, переносятся в новую секцию до её подключения.
+    # Операторные триггеры родительской таблицы при работе с секциями напрямую не срабатывают,
+    # поэтому перенос не меняет дневные итоги.
+    c.execute(f"CREATE TABLE {name} (LIKE operations INCLUDING DEFAULTS)")
+    c.execute(f'''WITH moved AS (
+            DELETE FROM {OPERATIONS_DEFAULT_PARTITION} WHERE operation_date >= %s AND operation_date < %s RETURNING *
+        ) INSERT INTO {name} SELECT * FROM moved''', (month, next_month(month)))
+    # Границы подставляются в текст: DDL не принимает параметры запроса
+    c.execute(f"ALTER TABLE operations ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{next_month(month)}')")
+    return True
+
+def ensure_operation_partitions(months_ahead=OPERATIONS_PARTITION_MONTHS_AHEAD):
+    # Та же блокировка, что у миграций и partition-operations: процессы не создают одну секцию одновременно
+    # и не работают с таблицей во время её перевода в секционированную. Возвращает имена созданных секций.
+    created = []
+    with get_db_pool().connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+        if not is_operations_partitioned(c):
+            return created
+        month = month_start(date.today())
+        for _ in range(months_ahead + 1):
+            if create_operations_partition(c, month):
+                created.append(operations_partition_name(month))
+            month = next_month(month)
+    for name in created:
+        log_action("Created operations partition", name)
+    return created
+
+def _operation_partitions_loop():
+    while True:
+        try:
+            ensure_operation_partitions()
+        except Exception:
+            logging.exception("Operations partition job failed")
+        time.sleep(OPERATIONS_PARTITION_CHECK_SECONDS)
+
+@st.cache_resource
+def start_operation_partitions_job():
+    # Раз в час проверяет, что секции на OPERATIONS_PARTITION_MONTHS_AHEAD месяцев вперёд созданы
+    job = threading.Thread(target=_operation_partitions_loop, name="pharma-operation-partitions", daemon=True)
+    job.start()
+    return job
+
+def partition_operations_table(c, months_ahead=OPERATIONS_PARTITION_MONTHS_AHEAD):
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+    if is_operations_partitioned(c):
+        return 0
+    c.execute("LOCK TABLE operations IN ACCESS EXCLUSIVE MODE")
+    c.execute("SELECT min(operation_date)::date, max(operation_date)::date FROM operations")
+    first_day, last_day = c.fetchone()
+    # Представление и последовательность привязаны к старой таблице: представление пересоздаётся,
+    # последовательность отвязывается, чтобы не удалиться вместе со старой таблицей
+    c.execute("DROP VIEW IF EXISTS operations_display")
+    c.execute("ALTER SEQUENCE operations_id_seq OWNED BY NONE")
+    c.execute("ALTER TABLE operations RENAME TO operations_unpartitioned")
+    c.execute('''CREATE TABLE operations (
+        id INTEGER NOT NULL DEFAULT nextval('operations_id_seq'),
+        medicine_id INTEGER REFERENCES medicines(id) ON DELETE SET NULL,
+        location_id INTEGER REFERENCES locations(id) ON DELETE SET NULL,
+        operation_type VARCHAR(50),
+        operation_date TIMESTAMP,
+        quantity INTEGER,
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) PARTITION BY RANGE (operation_date)''')
+    c.execute("ALTER SEQUENCE operations_id_seq OWNED BY operations.id")
+    c.execute(f"CREATE TABLE {OPERATIONS_DEFAULT_PARTITION} PARTITION OF operations DEFAULT")
+    month = month_start(first_day or date.today())
+    last_month = month_start(max(last_day or date.today(), date.today()))
+    for _ in range(months_ahead):
+        last_month = next_month(last_month)
+    while month <= last_month:
+        create_operations_partition(c, month)
+        month = next_month(month)
+    # Данные копируются до создания триггеров: дневные итоги для этих строк уже посчитаны
+    c.execute('''INSERT INTO operations (id, medicine_id, location_id, operation_type, operation_date, quantity, created_date)
+                 SELECT id, medicine_id, location_id, operation_type, operation_date, quantity, created_date
+                 FROM operations_unpartitioned''')
+    moved = c.rowcount
+    # Индексы переносятся со старой таблицы все, какие на ней были (и созданные позже миграциями).
+    # Первичный ключ по id на секционированной таблице невозможен, его заменяет обычный индекс.
+    c.execute('''SELECT indexdef FROM pg_indexes
+                 WHERE schemaname = current_schema() AND tablename = 'operations_unpartitioned' AND indexdef LIKE 'CREATE INDEX %' ''')
+    index_definitions = [re.sub(r" ON (\S+\.)?operations_unpartitioned ", " ON operations ", row[0], count=1) for row in c.fetchall()]
+    c.execute("DROP TABLE operations_unpartitioned")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_operations_id ON operations (id)")
+    for definition in index_definitions:
+        c.execute(definition.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
+    create_operations_triggers(c)
+    _migration_0007_display_views(c)
+    return moved
+
+def detach_operations_partition(c, month):
+    # Отключённая секция остаётся отдельной таблицей для архивирования; дневные итоги за этот месяц
+    # сохраняются, но rebuild-rollups после отключения пересчитает их только по подключённым секциям
+    name = operations_partition_name(month_start(month))
+    c.execute(f"ALTER TABLE operations DETACH PARTITION {name}")
+    return name
+
+
+# Кэш чтения: общий для всех сессий процесса. В ключ входят версии таблиц, от которых зависит
+# запрос; запись в таблицу увеличивает её версию, и устаревшие записи кэша больше не читаются.
+CACHE_TTL_SECONDS = int(os.environ.get("PHARMA_CACHE_TTL", 3600))  # Страховка на случай пропущенных уведомлений
+CACHE_MAX_ENTRIES = int(os.environ.get("PHARMA_CACHE_MAX_ENTRIES", 256))
+
+@st.cache_resource
+def get_table_versions():
+    return {"versions": {}, "lock": threading.Lock()}
+
+def get_table_version(*tables):
+    state = get_table_versions()
+    return tuple((table, state["versions"].get(table, 0)) for table in tables)
+
+def invalidate_tables(*tables):
+    state = get_table_versions()
+    with state["lock"]:
+        for table in tables:
+            state["versions"][table] = state["versions"].get(table, 0) + 1
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _cached_read_query(table_versions, query, params):
+    with get_db_pool().connection() as conn:
+        return pd.read_sql_query(query, conn, params=params)
+
+def read_query(tables, query, params=None):
+    # tables — таблицы, изменение которых делает результат запроса устаревшим
+    try:
+        return _cached_read_query(get_table_version(*tables), query, params)
+    except psycopg.Error as e:
+        st.error(f"Ошибка чтения данных: {e}")
         return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM medicines", conn)
-    conn.close()
-    return df
+
+# Слушатель изменений: сбрасывает кэш, когда любая реплика пишет в таблицы
+CHANGE_LISTENER_RETRY_SECONDS = 5
+CHANGE_LISTENER_PING_SECONDS = 60  # Без уведомлений дольше этого срока соединение проверяется запросом
+# TCP keepalive: обрыв сети без закрытия соединения обнаруживается за ~1,5 минуты, а не через часы
+CHANGE_LISTENER_KEEPALIVES = {"keepalives": 1, "keepalives_idle": 60, "keepalives_interval": 10, "keepalives_count": 3}
+
+def apply_change_notification(payload):
+    try:
+        change = json.loads(payload)
+    except ValueError:
+        return
+    if change.get("table") in CACHED_TABLES + JOB_TABLES:
+        invalidate_tables(change["table"])
+
+def _listen_for_changes():
+    while True:
+        try:
+            # Отдельное соединение вне пула: LISTEN держит его всё время работы процесса
+            with psycopg.connect(make_conninfo(get_db_conninfo(), **CHANGE_LISTENER_KEEPALIVES), autocommit=True) as conn:
+                conn.execute(f"LISTEN {CHANGE_NOTIFY_CHANNEL}")
+                # Пока слушатель был отключён, уведомления могли быть пропущены
+                invalidate_tables(*CACHED_TABLES, *JOB_TABLES)
+                while True:
+                    for notify in conn.notifies(timeout=CHANGE_LISTENER_PING_SECONDS):
+                        apply_change_notification(notify.payload)
+                    # Ожидание завершилось по тайм-ауту: разорванное соединение здесь вызовет ошибку и переподключение
+                    conn.execute("SELECT 1")
+        except psycopg.Error as e:
+            log_action("Change listener disconnected", str(e))
+        time.sleep(CHANGE_LISTENER_RETRY_SECONDS)
+
+@st.cache_resource
+def start_change_listener():
+    listener = threading.Thread(target=_listen_for_changes, name="pharma-change-listener", daemon=True)
+    listener.start()
+    return listener
+
+# Фоновая предзагрузка: запрос выполняется в отдельном потоке и кладёт результат в тот же кэш чтения
+PREFETCH_MAX_PENDING = 64
+
+@st.cache_resource
+def get_prefetch_executor():
+    # pending общий для всех сессий процесса, поэтому меняется только под lock
+    return {"executor": ThreadPoolExecutor(max_workers=2, thread_name_prefix="pharma-prefetch"), "pending": {}, "lock": threading.Lock()}
+
+def prefetch_query(tables, query, params=None):
+    state = get_prefetch_executor()
+    key = (get_table_version(*tables), query, params)
+    with state["lock"]:
+        pending = state["pending"]
+        if key in pending:
+            return
+        if len(pending) >= PREFETCH_MAX_PENDING:
+            # Результат завершённой предзагрузки уже лежит в кэше чтения, запись о ней больше не нужна;
+            # если все ещё выполняются, вытесняется самая старая
+            for done_key in [k for k, future in pending.items() if future.done()]:
+                del pending[done_key]
+            while len(pending) >= PREFETCH_MAX_PENDING:
+                del pending[next(iter(pending))]
+        pending[key] = state["executor"].submit(_cached_read_query, *key)
+
+def wait_prefetched(tables, query, params=None):
+    state = get_prefetch_executor()
+    with state["lock"]:
+        future = state["pending"].pop((get_table_version(*tables), query, params), None)
+    if future is not None:
+        try:
+            future.result()
+        except Exception:
+            pass  # Ошибка будет показана при обычном чтении через read_query
+
+# Функции получения данных
+def get_medications():
+    return read_query(("medicines",), "SELECT * FROM medicines")
 
 def get_companies():
-    conn = get_db_connection()
-    if conn is None:
-        return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM companies", conn)
-    conn.close()
-    return df
+    return read_query(("companies",), "SELECT * FROM companies")
 
 def get_locations():
-    conn = get_db_connection()
-    if conn is None:
-        return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM locations", conn)
-    conn.close()
-    return df
+    return read_query(("locations",), "SELECT * FROM locations")
 
 def get_operations():
-    conn = get_db_connection()
-    if conn is None:
-        return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM operations", conn)
-    conn.close()
-    return df
+    return read_query(("operations",), "SELECT * FROM operations")
 
 # Функции добавления
 def add_medication(name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code, username):
@@ -218,11 +867,12 @@ def add_medication(name, gtin, sku, market, batch_number, expiration_date, dosag
                   (name, gtin, sku, market, False, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code,
                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         conn.commit()
+        invalidate_tables("medicines")
         log_action("Added medication", f"ID: {c.lastrowid}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка добавления Препарата: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def add_company(gln, name_short, name_full, gcp_compliant, registration_country, address, type, username):
     conn = get_db_connection()
@@ -235,11 +885,12 @@ def add_company(gln, name_short, name_full, gcp_compliant, registration_country,
                      VALUES (%s, %s, %s, %s, %s, %s, %s)''',
                   (gln, name_short, name_full, gcp_compliant, registration_country, address, type))
         conn.commit()
+        invalidate_tables("companies")
         log_action("Added company", f"ID: {c.lastrowid}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка добавления компании: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def add_location(gln, country, address, role, name_short, name_full, owned_by, username):
     conn = get_db_connection()
@@ -253,11 +904,12 @@ def add_location(gln, country, address, role, name_short, name_full, owned_by, u
                   (gln, country, address, role, name_short, name_full, owned_by,
                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         conn.commit()
+        invalidate_tables("locations")
         log_action("Added location", f"ID: {c.lastrowid}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка добавления локации: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def add_operation(medicine_id, location_id, operation_type, operation_date, quantity, username):
     conn = get_db_connection()
@@ -271,11 +923,12 @@ def add_operation(medicine_id, location_id, operation_type, operation_date, quan
                   (medicine_id, location_id, operation_type, operation_date, quantity,
                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         conn.commit()
+        invalidate_tables("operations")
         log_action("Added operation", f"ID: {c.lastrowid}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка добавления операции: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 # Функции редактирования
 def edit_medication(med_id, name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code, username):
@@ -290,11 +943,12 @@ def edit_medication(med_id, name, gtin, sku, market, batch_number, expiration_da
                      WHERE id=%s''',
                   (name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code, med_id))
         conn.commit()
+        invalidate_tables("medicines")
         log_action("Edited medication", f"ID: {med_id}, Changed fields: {', '.join([f'{k}={v}' for k, v in {'name': name, 'gtin': gtin, 'sku': sku, 'market': market, 'batch_number': batch_number, 'expiration_date': str(expiration_date), 'dosage_form': dosage_form, 'active_ingredient': active_ingredient, 'package_size': package_size, 'owned_by': owned_by, 'atc_code': atc_code}.items() if v])}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка редактирования Препарата: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def edit_company(company_id, gln, name_short, name_full, gcp_compliant, registration_country, address, type, username):
     conn = get_db_connection()
@@ -307,11 +961,12 @@ def edit_company(company_id, gln, name_short, name_full, gcp_compliant, registra
                      WHERE id=%s''',
                   (gln, name_short, name_full, gcp_compliant, registration_country, address, type, company_id))
         conn.commit()
+        invalidate_tables("companies")
         log_action("Edited company", f"ID: {company_id}, Changed fields: {', '.join([f'{k}={v}' for k, v in {'gln': gln, 'name_short': name_short, 'name_full': name_full, 'gcp_compliant': str(gcp_compliant), 'registration_country': registration_country, 'address': address, 'type': type}.items() if v])}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка редактирования компании: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def edit_location(location_id, gln, country, address, role, name_short, name_full, owned_by, username):
     conn = get_db_connection()
@@ -324,11 +979,12 @@ def edit_location(location_id, gln, country, address, role, name_short, name_ful
                      WHERE id=%s''',
                   (gln, country, address, role, name_short, name_full, owned_by, location_id))
         conn.commit()
+        invalidate_tables("locations")
         log_action("Edited location", f"ID: {location_id}, Changed fields: {', '.join([f'{k}={v}' for k, v in {'gln': gln, 'country': country, 'address': address, 'role': role, 'name_short': name_short, 'name_full': name_full, 'owned_by': owned_by}.items() if v])}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка редактирования локации: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def edit_operation(operation_id, medicine_id, location_id, operation_type, operation_date, quantity, username):
     conn = get_db_connection()
@@ -341,11 +997,12 @@ def edit_operation(operation_id, medicine_id, location_id, operation_type, opera
                      WHERE id=%s''',
                   (medicine_id, location_id, operation_type, operation_date, quantity, operation_id))
         conn.commit()
+        invalidate_tables("operations")
         log_action("Edited operation", f"ID: {operation_id}, Changed fields: {', '.join([f'{k}={v}' for k, v in {'medicine_id': medicine_id, 'location_id': location_id, 'operation_type': operation_type, 'operation_date': str(operation_date), 'quantity': quantity}.items() if v])}", username)
     except psycopg2.Error as e:
         st.error(f"Ошибка редактирования операции: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 # Функции удаления с проверкой зависимостей
 def delete_medication(med_id):
@@ -360,11 +1017,12 @@ def delete_medication(med_id):
             return
         c.execute("DELETE FROM medicines WHERE id=%s", (med_id,))
         conn.commit()
+        invalidate_tables("medicines")
         log_action("Deleted medication", f"ID: {med_id}")
     except psycopg2.Error as e:
         st.error(f"Ошибка удаления Препарата: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def delete_company(company_id):
     conn = get_db_connection()
@@ -381,11 +1039,12 @@ def delete_company(company_id):
             return
         c.execute("DELETE FROM companies WHERE id=%s", (company_id,))
         conn.commit()
+        invalidate_tables("companies")
         log_action("Deleted company", f"ID: {company_id}")
     except psycopg2.Error as e:
         st.error(f"Ошибка удаления компании: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def delete_location(location_id):
     conn = get_db_connection()
@@ -399,11 +1058,12 @@ def delete_location(location_id):
             return
         c.execute("DELETE FROM locations WHERE id=%s", (location_id,))
         conn.commit()
+        invalidate_tables("locations")
         log_action("Deleted location", f"ID: {location_id}")
     except psycopg2.Error as e:
         st.error(f"Ошибка удаления локации: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def delete_operation(operation_id):
     conn = get_db_connection()
@@ -413,97 +1073,848 @@ def delete_operation(operation_id):
     try:
         c.execute("DELETE FROM operations WHERE id=%s", (operation_id,))
         conn.commit()
+        invalidate_tables("operations")
         log_action("Deleted operation", f"ID: {operation_id}")
     except psycopg2.Error as e:
         st.error(f"Ошибка удаления операции: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 # Импорт/экспорт данных
-def import_data(file):
-    conn = get_db_connection()
-    if conn is None:
+# Столбцы, которые принимаются из файла импорта для каждой таблицы
+IMPORT_COLUMNS = {
+    "medicines": ["name", "gtin", "sku", "market", "shared", "batch_number", "expiration_date", "dosage_form", "active_ingredient", "package_size", "owned_by", "atc_code"],
+    "companies": ["gln", "name_short", "name_full", "gcp_compliant", "registration_country", "address", "type"],
+    "locations": ["gln", "country", "address", "role", "name_short", "name_full", "owned_by"],
+    "operations": ["medicine_id", "location_id", "operation_type", "operation_date", "quantity"],
+}
+# Поля, при совпадении которых строка считается дубликатом и не импортируется
+IMPORT_DEDUPE_COLUMNS = {
+    "medicines": ["name", "gtin", "sku", "market", "batch_number", "expiration_date", "dosage_form", "active_ingredient", "package_size", "owned_by", "atc_code"],
+    "companies": ["gln", "name_short", "name_full", "gcp_compliant", "registration_country", "address", "type"],
+}
+# Обязательные поля из IMPORT_DEDUPE_COLUMNS: по ним дубликаты ищутся равенством (hash join или индекс),
+# остальные поля сравниваются IS NOT DISTINCT FROM уже как дополнительный фильтр
+IMPORT_DEDUPE_KEYS = {
+    "medicines": ["gtin", "sku"],
+    "companies": ["name_full", "name_short"],
+}
+IMPORT_INTEGER_COLUMNS = {"owned_by", "medicine_id", "location_id", "quantity"}
+IMPORT_FOREIGN_KEYS = {
+    "medicines": {"owned_by": "companies"},
+    "locations": {"owned_by": "companies"},
+    "operations": {"medicine_id": "medicines", "location_id": "locations"},
+}
+
+def prepare_import_frame(df, columns):
+    frame = df[columns].copy()
+    for col in columns:
+        if col in IMPORT_INTEGER_COLUMNS:
+            # Файл читается строками; COPY не примет "5.0" для INTEGER, поэтому число приводится к Int64
+            frame[col] = pd.to_numeric(frame[col], errors='coerce').astype('Int64')
+    frame = frame.astype(object)
+    return frame.where(frame.notna(), None)
+
+def bulk_import_frame(conn, table, df):
+    # COPY во временную таблицу и один INSERT ... SELECT с отсевом дубликатов вместо запросов на каждую строку
+    all_columns = IMPORT_COLUMNS[table]
+    columns = [col for col in all_columns if col in df.columns]
+    if not columns:
+        return 0, len(df)
+    staging = f"import_staging_{table}"
+    column_list = ", ".join(columns)
+    c = conn.cursor()
+    c.execute(f"DROP TABLE IF EXISTS {staging}")
+    c.execute(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {', '.join(all_columns)} FROM {table} WITH NO DATA")
+    with c.copy(f"COPY {staging} ({column_list}) FROM STDIN") as copy:
+        for record in prepare_import_frame(df, columns).itertuples(index=False, name=None):
+            copy.write_row(record)
+    dedupe_columns = IMPORT_DEDUPE_COLUMNS.get(table)
+    if dedupe_columns:
+        distinct_on = ", ".join(f"s.{col}" for col in dedupe_columns)
+        keys = IMPORT_DEDUPE_KEYS[table]
+        matches = " AND ".join([f"t.{col} = s.{col}" for col in keys] +
+                               [f"t.{col} IS NOT DISTINCT FROM s.{col}" for col in dedupe_columns if col not in keys])
+        c.execute(f'''INSERT INTO {table} ({column_list})
+                     SELECT DISTINCT ON ({distinct_on}) {", ".join(f"s.{col}" for col in columns)}
+                     FROM {staging} s
+                     WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {matches})''')
+    else:
+        c.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging}")
+    inserted = c.rowcount
+    return inserted, len(df) - inserted
+
+IMPORT_CHUNK_SIZE = int(os.environ.get("PHARMA_IMPORT_CHUNK_SIZE", 50000))
+IMPORT_FILE_TYPES = ['text/csv', 'application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']
+
+def get_import_file_key(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for block in iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+def iter_import_chunks(file, is_csv, chunk_size=IMPORT_CHUNK_SIZE):
+    # Файл разбирается порциями по chunk_size строк; вместе с порцией возвращается доля обработанного файла
+    if is_csv:
+        # Число строк оценивается по переводам строк, не загружая файл целиком
+        file.seek(0)
+        total_rows = max(sum(block.count(b'\n') for block in iter(lambda: file.read(1024 * 1024), b'')) - 1, 1)
+        file.seek(0)
+        rows_read = 0
+        # Все столбцы читаются как строки: иначе пропуск превращает GTIN/GLN во float, теряются ведущие нули,
+        # а типы столбцов различаются от порции к порции. Числа приводятся явно в prepare_import_frame
+        for chunk in pd.read_csv(file, chunksize=chunk_size, dtype=str):
+            rows_read += len(chunk)
+            yield chunk, min(rows_read / total_rows, 1.0)
         return
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        total_rows = max((sheet.max_row or 1) - 1, 1)
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(col) for col in header]
+        buffer = []
+        rows_read = 0
+        for row in rows:
+            # Ячейки приводятся к строкам, как при чтении CSV
+            buffer.append(tuple(None if value is None else str(value) for value in row))
+            if len(buffer) >= chunk_size:
+                yield pd.DataFrame(buffer, columns=header, index=pd.RangeIndex(rows_read, rows_read + len(buffer))), min((rows_read + len(buffer)) / total_rows, 1.0)
+                rows_read += len(buffer)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=header, index=pd.RangeIndex(rows_read, rows_read + len(buffer))), 1.0
+    finally:
+        workbook.close()
+
+def save_import_progress(c, import_key, file_name, summary, completed=False):
+    c.execute('''INSERT INTO import_progress
+                 (import_key, file_name, table_name, chunks_done, rows_done, inserted, skipped, rejected, completed, updated_at)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                 ON CONFLICT (import_key) DO UPDATE SET
+                     table_name = EXCLUDED.table_name, chunks_done = EXCLUDED.chunks_done, rows_done = EXCLUDED.rows_done,
+                     inserted = EXCLUDED.inserted, skipped = EXCLUDED.skipped, rejected = EXCLUDED.rejected,
+                     completed = EXCLUDED.completed, updated_at = EXCLUDED.updated_at''',
+              (import_key, file_name, summary["table"], summary["chunks"], summary["rows"], summary["inserted"],
+               summary["skipped"], summary["rejected"], completed, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+IMPORT_ERROR_REPORT_LIMIT = 1000  # Сколько ошибок валидации показывать пользователю
+
+def load_known_ids(conn, table):
+    # Множество существующих id для проверки внешних ключей импортируемых строк
+    c = conn.cursor()
+    known_ids = {}
+    for ref_table in set(IMPORT_FOREIGN_KEYS.get(table, {}).values()):
+        c.execute(f"SELECT id FROM {ref_table}")
+        known_ids[ref_table] = pd.Index([row[0] for row in c.fetchall()])
+    conn.commit()
+    return known_ids
+
+def run_import(conn, file, file_name, is_csv, progress=None):
+    # Каждая порция проверяется, загружается и фиксируется отдельной транзакцией вместе с записью о прогрессе,
+    # поэтому после сбоя повторный импорт того же файла продолжается с первой незагруженной порции
+    import_key = get_import_file_key(file)
     c = conn.cursor()
+    c.execute("SELECT table_name, chunks_done, rows_done, inserted, skipped, rejected, completed FROM import_progress WHERE import_key = %s", (import_key,))
+    state = c.fetchone()
+    conn.commit()
+    summary = {"table": None, "chunks": 0, "rows": 0, "inserted": 0, "skipped": 0, "rejected": 0, "resumed_from": 0,
+               "already_imported": False, "errors": pd.DataFrame(columns=["row", "column", "error"])}
+    if state:
+        summary.update(table=state[0], chunks=state[1], rows=state[2], inserted=state[3], skipped=state[4], rejected=state[5] or 0, resumed_from=state[1])
+        if state[6]:
+            summary["already_imported"] = True
+            return summary
+    known_ids = None
+    for chunk_index, (chunk, fraction) in enumerate(iter_import_chunks(file, is_csv)):
+        if chunk_index < summary["resumed_from"]:
+            continue
+        table = summary["table"] or chunk.columns[0].split('_')[0]
+        if table not in IMPORT_COLUMNS:
+            raise ValueError(f"Не удалось определить таблицу для импорта: {table}")
+        summary["table"] = table
+        if known_ids is None:
+            known_ids = load_known_ids(conn, table)
+        report = validate_frame(table, chunk, known_ids)
+        rows_total = len(chunk)
+        if not report.empty:
+            chunk = chunk.drop(index=report["row"].unique())
+            summary["rejected"] += rows_total - len(chunk)
+            if len(summary["errors"]) < IMPORT_ERROR_REPORT_LIMIT:
+                summary["errors"] = pd.concat([summary["errors"], report]).head(IMPORT_ERROR_REPORT_LIMIT)
+        inserted, skipped = bulk_import_frame(conn, table, chunk) if not chunk.empty else (0, 0)
+        summary["chunks"] += 1
+        summary["rows"] += rows_total
+        summary["inserted"] += inserted
+        summary["skipped"] += skipped
+        save_import_progress(c, import_key, file_name, summary)
+        conn.commit()
+        invalidate_tables(table)
+        if progress:
+            progress(fraction, summary)
+    save_import_progress(c, import_key, file_name, summary, completed=True)
+    conn.commit()
+    return summary
+
+def import_data(file):
+    if file.type not in IMPORT_FILE_TYPES:
+        st.error("Поддерживаются только CSV и Excel файлы")
+        return
+    # Импорт выполняется фоновой задачей; повторные запуски скрипта с тем же файлом показывают её состояние
+    file_key = get_import_file_key(file)
+    submitted = st.session_state.setdefault('import_jobs', {})
+    if file_key not in submitted:
+        job_id = submit_job("import", {"file_name": file.name, "is_csv": file.type == 'text/csv'}, st.session_state['username'], input_file=file)
+        if job_id is None:
+            return
+        submitted[file_key] = job_id
+    jobs = get_jobs(job_id=submitted[file_key])
+    if not jobs.empty:
+        job = next(jobs.itertuples())
+        show_job_status(job)
+        if job.status == "failed":
+            # Следующая отправка формы с этим файлом поставит импорт заново
+            del submitted[file_key]
+        # Кнопка скачивания недоступна внутри формы: отчёт об ошибках скачивается на странице «Задачи»
+        st.caption("Ход импорта и отчет об ошибках доступны на странице 'Задачи'.")
+
+# Экспорт: данные идут из базы в файл порциями (COPY TO STDOUT или именованный курсор), не собираясь в DataFrame
+EXPORT_FORMATS = {"Excel (XLSX)": "xlsx", "CSV": "csv", "CSV (gzip)": "csv.gz", "Parquet": "parquet"}
+EXPORT_MIME_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_FETCH_SIZE = int(os.environ.get("PHARMA_EXPORT_FETCH_SIZE", 10000))
+XLSX_SHEET_MAX_ROWS = 1048575  # Предел строк листа Excel без строки заголовка; дальше данные продолжаются на новом листе
+# Типы PostgreSQL -> типы Arrow; остальные столбцы записываются строками
+PARQUET_TYPE_NAMES = {"int2": "int16", "int4": "int32", "int8": "int64", "bool": "bool_", "float4": "float32",
+                      "float8": "float64", "date": "date32", "timestamp": "timestamp"}
+
+def export_formats():
+    return {title: fmt for title, fmt in EXPORT_FORMATS.items() if fmt != "parquet" or pa is not None}
+
+def export_query(table, columns=None):
+    return f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+
+def iter_export_batches(conn, query, params=None):
+    # Именованный (серверный) курсор: в памяти не больше EXPORT_FETCH_SIZE строк
+    with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cursor:
+        cursor.execute(query, params)
+        columns = [column.name for column in cursor.description]
+        type_names = [conn.adapters.types.get(column.type_code).name if conn.adapters.types.get(column.type_code) else None
+                      for column in cursor.description]
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        # Первая порция отдаётся даже пустой, чтобы записать заголовок или схему файла
+        yield columns, type_names, rows
+        while rows:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if rows:
+                yield columns, type_names, rows
+
+def write_csv_export(conn, query, path, params=None, compress=False):
+    rows = 0
+    with (gzip.open(path, "wb") if compress else open(path, "wb")) as output:
+        with conn.cursor() as cursor:
+            with cursor.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params) as copy:
+                for data in copy:
+                    output.write(data)
+            rows = cursor.rowcount
+    return rows
+
+def write_xlsx_sheets(conn, sheets, path):
+    # sheets — список (название листа, запрос, параметры); каждый запрос пишется на свои листы.
+    # constant_memory: каждая строка сбрасывается на диск сразу после записи
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "remove_timezone": True,
+                                          "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+    total = 0
     try:
-        if file.type in ['text/csv', 'application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']:
-            df = pd.read_csv(file) if file.type == 'text/csv' else pd.read_excel(file)
-            table = df.columns[0].split('_')[0]
-            if table == 'medicines':
-                for _, row in df.iterrows():
-                    c.execute('''SELECT id FROM medicines 
-                                 WHERE name = %s AND gtin = %s AND sku = %s AND market = %s 
-                                 AND batch_number = %s AND expiration_date = %s AND dosage_form = %s 
-                                 AND active_ingredient = %s AND package_size = %s AND owned_by = %s''AND atc_code = %s''',
-                              (row['name'], row['gtin'], row['sku'], row['market'], row['batch_number'],
-                               row['expiration_date'], row['dosage_form'], row['active_ingredient'], row['package_size'], row['owned_by'], row.get('atc_code', None)))
-                    if c.fetchone():
-                        continue
-                    c.execute('''INSERT INTO medicines 
-                                 (name, gtin, sku, market, shared, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, created_date) 
-                                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
-                              (row['name'], row['gtin'], row['sku'], row['market'], row['shared'], row['batch_number'],
-                               row['expiration_date'], row['dosage_form'], row['active_ingredient'], row['package_size'], row['owned_by'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            elif table == 'companies':
-                for _, row in df.iterrows():
-                    c.execute('''SELECT id FROM companies 
-                                 WHERE gln = %s AND name_short = %s AND name_full = %s 
-                                 AND gcp_compliant = %s AND registration_country = %s 
-                                 AND address = %s AND type = %s''',
-                              (row['gln'], row['name_short'], row['name_full'], row['gcp_compliant'],
-                               row['registration_country'], row['address'], row['type']))
-                    if c.fetchone():
-                        continue
-                    c.execute('''INSERT INTO companies 
-                                 (gln, name_short, name_full, gcp_compliant, registration_country, address, type) 
-                                 VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-                              (row['gln'], row['name_short'], row['name_full'], row['gcp_compliant'],
-                               row['registration_country'], row['address'], row['type']))
-            elif table == 'locations':
-                for _, row in df.iterrows():
-                    c.execute('''INSERT INTO locations 
-                                 (gln, country, address, role, name_short, name_full, owned_by, created_date) 
-                                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
-                              (row['gln'], row['country'], row['address'], row['role'], row['name_short'],
-                               row['name_full'], row['owned_by'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            elif table == 'operations':
-                for _, row in df.iterrows():
-                    c.execute('''INSERT INTO operations 
-                                 (medicine_id, location_id, operation_type, operation_date, quantity, created_date) 
-                                 VALUES (%s, %s, %s, %s, %s, %s)''',
-                              (row['medicine_id'], row['location_id'], row['operation_type'], row['operation_date'],
-                               row['quantity'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            conn.commit()
-            log_action(f"Imported data into {table}", f"Rows: {len(df)}")
-            st.success(f"Импортировано {len(df)} записей в таблицу {table}")
+        for sheet_title, query, params in sheets:
+            rows, sheet, sheet_row = 0, None, 0
+            for columns, _, batch in iter_export_batches(conn, query, params):
+                if sheet is None:
+                    sheet = workbook.add_worksheet(sheet_title[:28])
+                    sheet.write_row(0, 0, columns)
+                    sheet_row = 1
+                for record in batch:
+                    if sheet_row > XLSX_SHEET_MAX_ROWS:
+                        sheet = workbook.add_worksheet(f"{sheet_title[:24]}_{rows // XLSX_SHEET_MAX_ROWS + 1}")
+                        sheet.write_row(0, 0, columns)
+                        sheet_row = 1
+                    sheet.write_row(sheet_row, 0, record)
+                    sheet_row += 1
+                    rows += 1
+            total += rows
+    finally:
+        workbook.close()
+    return total
+
+def write_xlsx_export(conn, query, path, sheet_title, params=None):
+    return write_xlsx_sheets(conn, [(sheet_title, query, params)], path)
+
+def parquet_schema(columns, type_names):
+    fields = []
+    for column, type_name in zip(columns, type_names):
+        arrow_type = PARQUET_TYPE_NAMES.get(type_name)
+        if arrow_type == "timestamp":
+            fields.append((column, pa.timestamp("us")))
         else:
-            st.error("Поддерживаются только CSV и Excel файлы")
-    except Exception as e:
-        st.error(f"Ошибка импорта: {e}")
+            fields.append((column, getattr(pa, arrow_type)() if arrow_type else pa.string()))
+    return pa.schema(fields)
+
+def write_parquet_export(conn, query, path, params=None):
+    rows, writer = 0, None
+    try:
+        for columns, type_names, batch in iter_export_batches(conn, query, params):
+            if writer is None:
+                schema = parquet_schema(columns, type_names)
+                as_text = [field.type == pa.string() for field in schema]
+                writer = pq.ParquetWriter(path, schema)
+            if not batch:
+                continue
+            arrays = []
+            for field, text, values in zip(schema, as_text, zip(*batch)):
+                if text:
+                    values = [None if value is None else str(value) for value in values]
+                arrays.append(pa.array(values, type=field.type))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            rows += len(batch)
     finally:
-        conn.close()
+        if writer is not None:
+            writer.close()
+    return rows
 
-def export_data(table):
-    conn = get_db_connection()
-    if conn is None:
+def write_export(conn, query, fmt, path, sheet_title="export", params=None):
+    if fmt == "csv":
+        return write_csv_export(conn, query, path, params)
+    if fmt == "csv.gz":
+        return write_csv_export(conn, query, path, params, compress=True)
+    if fmt == "xlsx":
+        return write_xlsx_export(conn, query, path, sheet_title, params)
+    if fmt == "parquet":
+        if pa is None:
+            raise ValueError("Для экспорта в Parquet установите пакет pyarrow")
+        return write_parquet_export(conn, query, path, params)
+    raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+
+def export_data(table, columns=None, fmt="xlsx"):
+    # Файл собирается во временном каталоге и удаляется после передачи в кнопку скачивания
+    with NamedTemporaryFile(suffix=f".{fmt}", delete=False) as output:
+        path = output.name
+    try:
+        with get_db_pool().connection() as conn:
+            rows = write_export(conn, export_query(table, columns), fmt, path, sheet_title=table)
+        log_action(f"Exported data from {table}", f"Rows: {rows}, format: {fmt}")
+        with open(path, "rb") as exported:
+            st.download_button(label=f"Экспорт {table}", data=exported, file_name=f"{table}_export.{fmt}", mime=EXPORT_MIME_TYPES[fmt])
+    except (psycopg.Error, ValueError) as e:
+        st.error(f"Ошибка экспорта: {e}")
+    finally:
+        os.remove(path)
+
+# Архив всех данных: четыре таблицы читаются в одном снимке REPEATABLE READ, поэтому ссылки между ними согласованы.
+# Снимок экспортируется (pg_export_snapshot), и каждая таблица выгружается своим соединением параллельно.
+BUNDLE_TABLES = ("companies", "medicines", "locations", "operations")  # Порядок загрузки: сначала таблицы, на которые ссылаются
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_WORKERS = int(os.environ.get("PHARMA_BUNDLE_WORKERS", 4))
+BUNDLE_COPY_CHUNK_SIZE = 1 << 20
+
+def begin_snapshot_transaction(conn, snapshot_id=None):
+    conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    if snapshot_id:
+        # SET TRANSACTION SNAPSHOT не принимает параметры запроса
+        conn.execute(sql.SQL("SET TRANSACTION SNAPSHOT {}").format(sql.Literal(snapshot_id)))
+
+def get_table_columns(conn, table):
+    rows = conn.execute('''SELECT column_name FROM information_schema.columns
+                           WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position''', (table,)).fetchall()
+    return [row[0] for row in rows]
+
+def dump_bundle_table(snapshot_id, table, columns, directory):
+    # Сжатие выполняется здесь же, в потоке таблицы; в архив файлы кладутся без повторного сжатия
+    file_name = f"{table}.csv.gz"
+    digest = hashlib.sha256()
+    with get_db_pool().connection() as conn:
+        begin_snapshot_transaction(conn, snapshot_id)
+        with conn.cursor() as cursor, gzip.open(os.path.join(directory, file_name), "wb") as output:
+            with cursor.copy(f"COPY (SELECT {', '.join(columns)} FROM {table}) TO STDOUT WITH (FORMAT csv, HEADER)") as copy:
+                for data in copy:
+                    digest.update(data)
+                    output.write(data)
+            rows = cursor.rowcount
+        conn.rollback()
+    return {"file": file_name, "rows": rows, "columns": columns, "sha256": digest.hexdigest()}
+
+def export_bundle(path, workers=BUNDLE_WORKERS):
+    with get_db_pool().connection() as conn, TemporaryDirectory() as directory:
+        # Транзакция-координатор держит снимок открытым, пока его используют потоки выгрузки
+        begin_snapshot_transaction(conn)
+        snapshot_id = conn.execute("SELECT pg_export_snapshot()").fetchone()[0]
+        schema_version = get_schema_version(conn.cursor())
+        columns = {table: get_table_columns(conn, table) for table in BUNDLE_TABLES}
+        # Координатор уже занял соединение пула; ещё одно остаётся свободным для остальных запросов приложения
+        workers = max(1, min(workers, len(BUNDLE_TABLES), DB_POOL_MAX_SIZE - 2))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pharma-bundle") as executor:
+            futures = {table: executor.submit(dump_bundle_table, snapshot_id, table, columns[table], directory) for table in BUNDLE_TABLES}
+            tables = {table: future.result() for table, future in futures.items()}
+        conn.rollback()
+        manifest = {"format_version": BUNDLE_FORMAT_VERSION, "schema_version": schema_version,
+                    "created_at": datetime.now().isoformat(timespec="seconds"), "tables": tables}
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as bundle:
+            bundle.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+            for info in tables.values():
+                bundle.write(os.path.join(directory, info["file"]), info["file"])
+    return manifest
+
+def restore_bundle(source):
+    # Данные заменяются целиком в одной транзакции: при любой ошибке база остаётся как была.
+    # Дневные итоги и остатки пересчитываются триггерами на TRUNCATE и на загрузку COPY,
+    # список истекающих препаратов строится заново, а прогресс прежних импортов сбрасывается.
+    with zipfile.ZipFile(source) as bundle:
+        manifest = json.loads(bundle.read("manifest.json"))
+        if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия архива: {manifest.get('format_version')}")
+        restored = {}
+        with get_db_pool().connection() as conn:
+            c = conn.cursor()
+            if manifest["schema_version"] > get_schema_version(c):
+                raise ValueError("Архив создан на более новой версии схемы базы данных")
+            # Имена столбцов берутся из архива, поэтому принимаются только существующие столбцы таблицы
+            for table in BUNDLE_TABLES:
+                known = set(get_table_columns(conn, table))
+                unknown = [col for col in manifest["tables"][table]["columns"] if col not in known]
+                if unknown:
+                    raise ValueError(f"В таблице {table} нет столбцов: {', '.join(map(str, unknown))}")
+            c.execute(f"TRUNCATE {', '.join(BUNDLE_TABLES)} RESTART IDENTITY")
+            for table in BUNDLE_TABLES:
+                info = manifest["tables"][table]
+                digest = hashlib.sha256()
+                with bundle.open(info["file"]) as member, gzip.open(member) as data:
+                    copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER)").format(
+                        sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, info["columns"])))
+                    with c.copy(copy_query) as copy:
+                        while chunk := data.read(BUNDLE_COPY_CHUNK_SIZE):
+                            digest.update(chunk)
+                            copy.write(chunk)
+                restored[table] = c.rowcount
+                if digest.hexdigest() != info["sha256"]:
+                    raise ValueError(f"Контрольная сумма {info['file']} не совпадает с манифестом")
+                c.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(max(id), 1), max(id) IS NOT NULL) FROM {table}")
+            c.execute("DELETE FROM import_progress")
+            c.execute("SELECT pg_advisory_xact_lock(%s)", (EXPIRY_ALERT_LOCK_ID,))
+            generate_expiry_alerts(c, date.today())
+            conn.commit()
+    invalidate_tables(*BUNDLE_TABLES, "expiry_alerts")
+    return restored
+
+def show_backups():
+    if st.session_state['role'] != 'admin':
+        st.error("Доступ запрещен")
+        return
+    st.subheader("Резервные копии")
+    st.write("Архив содержит компании, препараты, локации и операции на один момент времени.")
+    if st.button("Создать архив"):
+        with NamedTemporaryFile(suffix=".zip", delete=False) as output:
+            path = output.name
+        try:
+            manifest = export_bundle(path)
+            rows = ", ".join(f"{table}: {info['rows']}" for table, info in manifest["tables"].items())
+            log_action("Exported data bundle", rows, st.session_state['username'])
+            st.success(f"Архив создан ({rows})")
+            with open(path, "rb") as bundle:
+                st.download_button("Скачать архив", data=bundle, file_name=f"pharma_bundle_{datetime.now():%Y%m%d_%H%M%S}.zip", mime="application/zip")
+        except psycopg.Error as e:
+            st.error(f"Ошибка создания архива: {e}")
+        finally:
+            os.remove(path)
+    st.write("### Восстановление")
+    st.warning("Восстановление заменяет все компании, препараты, локации и операции данными из архива.")
+    uploaded = st.file_uploader("Архив", type=["zip"])
+    confirm = st.checkbox("Я понимаю, что текущие данные будут удалены")
+    if uploaded is not None and st.button("Восстановить", disabled=not confirm):
+        try:
+            restored = restore_bundle(uploaded)
+            rows = ", ".join(f"{table}: {count}" for table, count in restored.items())
+            log_action("Restored data bundle", f"File: {uploaded.name}, {rows}", st.session_state['username'])
+            st.success(f"Данные восстановлены ({rows})")
+        except (psycopg.Error, ValueError, KeyError, zipfile.BadZipFile) as e:
+            st.error(f"Ошибка восстановления: {e}")
+
+# Фоновые задачи: запись в таблице jobs и выполнение в пуле потоков процесса. Страница пользователя
+# только ставит задачу и читает её состояние, поэтому перезапуск скрипта или обновление браузера её не прерывает.
+# При нескольких экземплярах приложения каталог должен быть общим (сетевой том): загруженный файл импорта
+# и результат задачи нужны тому процессу, который выполняет задачу или отдаёт файл пользователю
+JOB_RESULTS_DIR = os.path.abspath(os.environ.get("PHARMA_JOB_DIR", "job_results"))
+JOB_WORKERS = int(os.environ.get("PHARMA_JOB_WORKERS", 2))
+JOB_HEARTBEAT_SECONDS = 15
+JOB_STALE_SECONDS = 60  # Процесс без отметки дольше этого срока считается остановленным, его задачи — прерванными
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"  # Уникален для каждого запуска процесса
+JOB_RESULT_TTL_DAYS = int(os.environ.get("PHARMA_JOB_RESULT_TTL_DAYS", 7))
+JOB_PROGRESS_INTERVAL_SECONDS = 1
+JOB_LIST_LIMIT = 50
+JOB_REFRESH_SECONDS = 2
+JOB_REFRESH_MAX_RUNS = 150  # Автообновление страницы задач не дольше ~5 минут подряд
+JOB_KIND_TITLES = {"import": "Импорт", "export": "Экспорт", "report": "Отчет", "report_batch": "Пакет отчетов", "trace": "Прослеживаемость"}
+JOB_STATUS_TITLES = {"queued": "В очереди", "running": "Выполняется", "done": "Готово", "failed": "Ошибка"}
+
+def job_file_path(name):
+    os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+    return os.path.join(JOB_RESULTS_DIR, f"{uuid.uuid4().hex}_{re.sub(r'[^0-9A-Za-zА-Яа-я._-]', '_', name)}")
+
+def update_job(job_id, **fields):
+    assignments = ", ".join(f"{name} = %s" for name in fields)
+    with get_db_pool().connection() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (*fields.values(), job_id))
+
+def job_progress_reporter(job_id):
+    # Прогресс пишется в базу не чаще раза в секунду
+    last_update = [0.0]
+
+    def report(fraction, message):
+        now = time.monotonic()
+        if now - last_update[0] >= JOB_PROGRESS_INTERVAL_SECONDS:
+            update_job(job_id, progress=float(fraction), message=message)
+            last_update[0] = now
+    return report
+
+def run_import_job(job_id, params):
+    report = job_progress_reporter(job_id)
+    with get_db_pool().connection() as conn, open(params["input_path"], "rb") as file:
+        summary = run_import(conn, file, params["file_name"], params["is_csv"],
+                             lambda fraction, summary: report(fraction, f"Таблица {summary['table']}: обработано {summary['rows']} строк"))
+    os.remove(params["input_path"])
+    if summary["already_imported"]:
+        return f"Файл {params['file_name']} уже импортирован в таблицу {summary['table']}", None, None
+    log_action(f"Imported data into {summary['table']}", f"Rows: {summary['rows']}, inserted: {summary['inserted']}, skipped: {summary['skipped']}, rejected: {summary['rejected']}, resumed from chunk: {summary['resumed_from']}")
+    message = f"Импортировано {summary['inserted']} записей в таблицу {summary['table']}, пропущено дубликатов: {summary['skipped']}"
+    if not summary["rejected"]:
+        return message, None, None
+    # Отчёт об ошибках — результат задачи; номер строки в файле с учётом заголовка
+    errors = summary["errors"].assign(row=summary["errors"]["row"] + 2)
+    path = job_file_path("import_errors.csv")
+    errors.rename(columns={"row": "Строка файла", "column": "Поле", "error": "Ошибка"}).to_csv(path, index=False)
+    return f"{message}, отклонено строк с ошибками: {summary['rejected']}", path, f"{os.path.splitext(params['file_name'])[0]}_errors.csv"
+
+def run_export_job(job_id, params):
+    file_name = f"{params['table']}_export.{params['format']}"
+    path = job_file_path(file_name)
+    with get_db_pool().connection() as conn:
+        rows = write_export(conn, export_query(params["table"], params.get("columns")), params["format"], path, sheet_title=params["table"])
+    log_action(f"Exported data from {params['table']}", f"Rows: {rows}, format: {params['format']}")
+    return f"Выгружено строк: {rows}", path, file_name
+
+def run_report_job(job_id, params):
+    file_name = f"{params['title']}.docx"
+    path = job_file_path(file_name)
+    with open(path, "wb") as output:
+        output.write(build_medicine_report(params["title"], params["medicine_id"]))
+    log_action("Generated report", f"Title: {params['title']}")
+    return "Отчет сформирован", path, file_name
+
+def run_report_batch_job(job_id, params):
+    med_ids = select_report_medicines(params.get("medicine_ids"), params.get("company_id"), params.get("atc_prefix"))
+    if not med_ids:
+        return "Нет препаратов по заданным условиям", None, None
+    file_name = f"{params['title']}.zip"
+    path = job_file_path(file_name)
+    reports = build_report_batch(params["title"], med_ids, path, job_progress_reporter(job_id))
+    log_action("Generated report batch", f"Title: {params['title']}, reports: {reports}")
+    return f"Сформировано отчетов: {reports}", path, file_name
+
+def run_trace_job(job_id, params):
+    file_name = f"trace_{TRACE_KEYS[params['key']]}_{re.sub(r'[^0-9A-Za-z_-]', '_', params['value'])}.{params['format']}"
+    path = job_file_path(file_name)
+    with get_db_pool().connection() as conn:
+        rows = write_trace_export(conn, params["key"], params["value"], params["format"], path)
+    log_action("Exported traceability report", f"{params['key']}: {params['value']}, rows: {rows}, format: {params['format']}")
+    return f"Выгружено строк: {rows}", path, file_name
+
+JOB_HANDLERS = {"import": run_import_job, "export": run_export_job, "report": run_report_job, "report_batch": run_report_batch_job,
+                "trace": run_trace_job}
+
+def run_job(job_id):
+    # Задачу забирает тот процесс, который первым переведёт её из очереди в работу
+    with get_db_pool().connection() as conn:
+        job = conn.execute('''UPDATE jobs SET status = 'running', owner = %s, started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                              WHERE id = %s AND status = 'queued' RETURNING kind, params''', (JOB_OWNER, job_id)).fetchone()
+    if job is None:
         return
-    df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
-    conn.close()
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name=table, index=False)
-    log_action(f"Exported data from {table}", f"Rows: {len(df)}")
-    st.download_button(label=f"Экспорт {table}", data=output.getvalue(),
-                      file_name=f"{table}_export.xlsx",
-                      mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    kind, params = job
+    try:
+        message, result_path, result_name = JOB_HANDLERS[kind](job_id, params)
+        update_job(job_id, status="done", progress=1.0, message=message, result_path=result_path, result_name=result_name, finished_at=datetime.now())
+    except Exception as e:
+        log_action("Job failed", f"ID: {job_id}, kind: {kind}, error: {e}")
+        update_job(job_id, status="failed", message=str(e), finished_at=datetime.now())
+
+def cleanup_jobs(conn):
+    # Выполнявшиеся задачи остановленных процессов помечаются ошибкой, задачи из их очереди забирает этот процесс,
+    # старые результаты удаляются с диска. Возвращает id перехваченных задач из очереди.
+    conn.execute("DELETE FROM job_workers WHERE heartbeat_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'", (JOB_STALE_SECONDS,))
+    dead_owner = "(owner IS NULL OR NOT EXISTS (SELECT 1 FROM job_workers w WHERE w.owner = jobs.owner))"
+    conn.execute(f'''UPDATE jobs SET status = 'failed', message = 'Задача прервана остановкой сервера', finished_at = CURRENT_TIMESTAMP
+                     WHERE status = 'running' AND {dead_owner}''')
+    # Забираются только задачи, загруженный файл которых виден этому процессу. Остальные ждут живой процесс на сервере,
+    # где файл был загружен, а если такого нет — завершаются ошибкой
+    same_host_alive = "EXISTS (SELECT 1 FROM job_workers w WHERE split_part(w.owner, ':', 1) = split_part(jobs.owner, ':', 1))"
+    orphaned = conn.execute(f'''SELECT id, params, {same_host_alive} FROM jobs
+                                WHERE status = 'queued' AND {dead_owner} FOR UPDATE SKIP LOCKED''').fetchall()
+    queued = [job_id for job_id, params, _ in orphaned if not params.get("input_path") or os.path.exists(params["input_path"])]
+    lost = [job_id for job_id, _, host_alive in orphaned if not host_alive and job_id not in queued]
+    conn.execute("UPDATE jobs SET owner = %s WHERE id = ANY(%s)", (JOB_OWNER, queued))
+    conn.execute('''UPDATE jobs SET status = 'failed', message = 'Загруженный файл недоступен: он остался на другом сервере',
+                    finished_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)''', (lost,))
+    expired = conn.execute("DELETE FROM jobs WHERE finished_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day' RETURNING result_path, params",
+                           (JOB_RESULT_TTL_DAYS,)).fetchall()
+    for result_path, params in expired:
+        for path in (result_path, params.get("input_path")):
+            if path and os.path.exists(path):
+                os.remove(path)
+    return sorted(queued)
+
+def job_heartbeat(executor):
+    # Отметка процесса и уборка за остановленными процессами; задачи из их очереди продолжают выполняться здесь
+    with get_db_pool().connection() as conn:
+        conn.execute('''INSERT INTO job_workers (owner) VALUES (%s)
+                        ON CONFLICT (owner) DO UPDATE SET heartbeat_at = CURRENT_TIMESTAMP''', (JOB_OWNER,))
+        # Экспорт и отчёты не сообщают прогресс, поэтому живость их задач видна по updated_at
+        conn.execute("UPDATE jobs SET updated_at = CURRENT_TIMESTAMP WHERE owner = %s AND status = 'running'", (JOB_OWNER,))
+        queued = cleanup_jobs(conn)
+    for job_id in queued:
+        executor.submit(run_job, job_id)
+
+def _job_heartbeat_loop(executor):
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            job_heartbeat(executor)
+        except Exception:
+            logging.exception("Job heartbeat failed")
+
+@st.cache_resource
+def get_job_executor():
+    executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="pharma-job")
+    try:
+        job_heartbeat(executor)
+    except psycopg.Error as e:
+        log_action("Job queue recovery failed", str(e))
+    threading.Thread(target=_job_heartbeat_loop, args=(executor,), name="pharma-job-heartbeat", daemon=True).start()
+    return executor
+
+def submit_job(kind, params, username, input_file=None):
+    if input_file is not None:
+        # Загруженный файл сохраняется на диск: задача выполняется после завершения запуска скрипта
+        params["input_path"] = job_file_path(params.get("file_name", "input"))
+        input_file.seek(0)
+        with open(params["input_path"], "wb") as output:
+            for block in iter(lambda: input_file.read(1024 * 1024), b''):
+                output.write(block)
+        input_file.seek(0)
+    try:
+        with get_db_pool().connection() as conn:
+            job_id = conn.execute("INSERT INTO jobs (kind, params, created_by, owner) VALUES (%s, %s, %s, %s) RETURNING id",
+                                  (kind, Jsonb(params), username, JOB_OWNER)).fetchone()[0]
+    except psycopg.Error as e:
+        st.error(f"Ошибка постановки задачи: {e}")
+        return None
+    get_job_executor().submit(run_job, job_id)
+    log_action("Submitted job", f"ID: {job_id}, kind: {kind}", username)
+    return job_id
+
+def get_jobs(username=None, job_id=None, limit=JOB_LIST_LIMIT):
+    # Состояние задач меняется постоянно, поэтому читается мимо кэша
+    conditions, params = [], []
+    if username is not None:
+        conditions.append("created_by = %s")
+        params.append(username)
+    if job_id is not None:
+        conditions.append("id = %s")
+        params.append(job_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    try:
+        with get_db_pool().connection() as conn:
+            return pd.read_sql_query(f'''SELECT id, kind, status, progress, message, result_path, result_name, created_by, created_at, finished_at,
+                                                 updated_at
+                                          FROM jobs {where} ORDER BY id DESC LIMIT %s''', conn, params=(*params, limit))
+    except psycopg.Error as e:
+        st.error(f"Ошибка чтения задач: {e}")
+        return pd.DataFrame()
+
+def show_job_status(job):
+    st.write(f"#{job.id} · {JOB_KIND_TITLES.get(job.kind, job.kind)} · {JOB_STATUS_TITLES.get(job.status, job.status)} · {job.created_at:%Y-%m-%d %H:%M}")
+    if job.status in ("queued", "running"):
+        st.progress(min(float(job.progress), 1.0), text=job.message or "")
+    elif job.status == "failed":
+        st.error(job.message)
+    elif job.message:
+        st.caption(job.message)
+
+def show_job_download(job):
+    if job.result_path and os.path.exists(job.result_path):
+        with open(job.result_path, "rb") as result:
+            st.download_button(f"Скачать {job.result_name}", data=result, file_name=job.result_name, key=f"job_{job.id}_download")
+    elif job.result_path:
+        st.info(f"Файл {job.result_name} сохранен на другом сервере и здесь недоступен. "
+                "Для общего доступа к результатам задайте PHARMA_JOB_DIR на общем каталоге.")
+
+def show_jobs():
+    st.subheader("Задачи")
+    jobs = get_jobs(None if st.session_state['role'] == 'admin' else st.session_state['username'])
+    if jobs.empty:
+        st.info("Задач пока нет. Импорт, экспорт в фоне и отчеты в фоне появятся здесь.")
+        return
+    for job in jobs.itertuples():
+        show_job_status(job)
+    finished = {f"#{job.id} {job.result_name}": job for job in jobs.itertuples() if job.status == "done" and job.result_path}
+    if finished:
+        # Файл читается только для выбранной задачи, а не для всех сразу
+        show_job_download(finished[st.selectbox("Результат для скачивания", list(finished.keys()))])
+    # Обновляется, только пока задачи действительно выполняются: зависшие без обновлений задачи страницу не держат
+    fresh = jobs['updated_at'] >= datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)
+    active = ((jobs['status'] == "queued") | ((jobs['status'] == "running") & fresh)).any()
+    runs = st.session_state.get('job_refresh_runs', 0)
+    if not active:
+        st.session_state['job_refresh_runs'] = 0
+    elif runs >= JOB_REFRESH_MAX_RUNS:
+        st.caption("Автообновление остановлено")
+        if st.button("Обновить"):
+            st.session_state['job_refresh_runs'] = 0
+            st.rerun()
+    elif st.checkbox("Обновлять автоматически", value=True):
+        st.session_state['job_refresh_runs'] = runs + 1
+        time.sleep(JOB_REFRESH_SECONDS)
+        st.rerun()
 
 # Валидация данных
+ATC_CODE_PATTERN = r'[A-Z]{1,2}[0-9]{2}[A-Z]{0,2}[0-9]{0,2}'
+
+# Максимальная длина текстовых полей — по размерам VARCHAR в схеме
+TABLE_COLUMN_LIMITS = {
+    "medicines": {"name": 50, "gtin": 20, "sku": 20, "market": 20, "batch_number": 50, "dosage_form": 50,
+                  "active_ingredient": 100, "package_size": 50, "atc_code": 20},
+    "companies": {"gln": 20, "name_short": 50, "name_full": 100, "registration_country": 50, "address": 200, "type": 50},
+    "locations": {"gln": 20, "country": 50, "address": 200, "role": 50, "name_short": 50, "name_full": 100},
+    "operations": {"operation_type": 50},
+}
+# Обязательные поля и сообщения — те же правила, что в validate_*_data
+TABLE_REQUIRED_COLUMNS = {
+    "medicines": {"name": "Название не может быть пустым", "gtin": "GTIN не может быть пустым", "sku": "SKU не может быть пустым",
+                  "market": "Рынок не может быть пустым", "batch_number": "Номер партии не может быть пустым",
+                  "expiration_date": "Срок годности обязателен", "dosage_form": "Форма выпуска обязательна",
+                  "active_ingredient": "Активный ингредиент обязателен", "package_size": "Объем/Размер упаковки обязателен",
+                  "owned_by": "Компания-владелец обязательна"},
+    "companies": {"name_short": "Краткое название не может быть пустым", "name_full": "Полное название не может быть пустым"},
+    "locations": {"address": "Адрес не может быть пустым", "owned_by": "Компания-владелец обязательна"},
+    "operations": {"medicine_id": "ID Препарата обязателен", "location_id": "ID локации обязателен",
+                   "operation_type": "Тип операции не может быть пустым", "operation_date": "Дата операции обязательна",
+                   "quantity": "Количество должно быть больше 0"},
+}
+DATE_COLUMNS = {"expiration_date", "operation_date", "created_date"}
+INTEGER_MAX = 2147483647  # Предел типа INTEGER в PostgreSQL
+
+# Проверка контрольной цифры GS1
+GTIN_LENGTHS = (8, 12, 13, 14)
+GLN_LENGTHS = (13,)
+GS1_COLUMNS = {"medicines": {"gtin": GTIN_LENGTHS}, "companies": {"gln": GLN_LENGTHS}, "locations": {"gln": GLN_LENGTHS}}
+GS1_BLOCK_SIZE = 262144  # Строк на блок: ограничивает размер промежуточных матриц
+
+def import_text_values(values):
+    # Значения приводятся к строкам до проверки: числовой столбец (например, GTIN с пропуском, прочитанный как float)
+    # иначе превращается в "4006381333931.0" и не проходит проверку
+    values = pd.Series(values)
+    if values.dtype.kind == 'f':
+        integral = values.notna() & (values % 1 == 0)
+        return values.where(integral).astype('Int64').astype(str).where(integral, values.astype(str)).where(values.notna(), '')
+    if values.dtype.kind in 'iub':
+        return values.astype(str)
+    # Файлы импорта читаются строками (iter_import_chunks), поэтому обычно остаётся только этот путь
+    return values.fillna('').astype(str).str.strip()
+
+def gs1_check_digits_valid(codes, lengths=GTIN_LENGTHS):
+    # Коды раскладываются в матрицу кодовых точек (строка — код, столбец — символ) и проверяются без цикла по кодам.
+    # Сумма цифр с весами 3/1 справа налево (контрольная цифра с весом 1) должна делиться на 10;
+    # вес позиции зависит только от её чётности и чётности длины кода.
+    chars = import_text_values(codes).to_numpy(dtype='U20')
+    points = chars.view(np.uint32).reshape(len(chars), 20)
+    result = np.zeros(len(chars), dtype=bool)
+    for start in range(0, len(chars), GS1_BLOCK_SIZE):
+        block = points[start:start + GS1_BLOCK_SIZE]
+        padding = block == 0
+        digits = block - 48  # uint32: у любых символов, кроме цифр, значение больше 9
+        length = 20 - padding.sum(axis=1)
+        valid = np.isin(length, lengths) & ((digits <= 9) | padding).all(axis=1)
+        digits[padding] = 0
+        even = digits[:, 0::2].sum(axis=1)
+        odd = digits[:, 1::2].sum(axis=1)
+        total = np.where(length % 2 == 0, 3 * even + odd, 3 * odd + even)
+        result[start:start + GS1_BLOCK_SIZE] = valid & (total % 10 == 0)
+    return result
+
+def validate_frame(table, df, known_ids=None):
+    # Проверка всего DataFrame векторными масками; возвращает отчёт (row — индекс строки в df, column, error)
+    reports = []
+
+    def reject(mask, column, message):
+        mask = pd.Series(mask, index=df.index).fillna(False).astype(bool)
+        if mask.any():
+            reports.append(pd.DataFrame({"row": df.index[mask.to_numpy()], "column": column, "error": message}))
+
+    texts = {col: import_text_values(df[col]) for col in df.columns if col in IMPORT_COLUMNS[table]}
+    for column, message in TABLE_REQUIRED_COLUMNS[table].items():
+        if column not in texts:
+            reject(True, column, message)
+        else:
+            reject(texts[column] == '', column, message)
+    for column, limit in TABLE_COLUMN_LIMITS[table].items():
+        if column in texts:
+            reject(texts[column].str.len() > limit, column, f"Значение длиннее {limit} символов")
+    for column, lengths in GS1_COLUMNS.get(table, {}).items():
+        if column in texts:
+            reject((texts[column] != '') & ~gs1_check_digits_valid(texts[column], lengths), column, f"{column.upper()} имеет неверную длину или контрольную цифру")
+    if "atc_code" in texts:
+        atc = texts["atc_code"]
+        reject((atc != '') & ~atc.str.fullmatch(ATC_CODE_PATTERN), "atc_code", "Код АТС имеет неверный формат (пример: A10BA02)")
+    for column in DATE_COLUMNS & texts.keys():
+        # Без format pandas берёт формат первого значения порции, и остальные форматы становятся NaT.
+        # ISO 8601 (дата с временем и без) разбирается векторно, прочие записи — поштучно
+        parsed = pd.to_datetime(texts[column], errors='coerce', format='ISO8601')
+        retry = parsed.isna() & (texts[column] != '')
+        if retry.any():
+            parsed[retry] = pd.to_datetime(texts[column][retry], errors='coerce', format='mixed')
+        reject((texts[column] != '') & parsed.isna(), column, "Неверный формат даты")
+    # Целые столбцы: дробные и не помещающиеся в INTEGER значения отклоняются здесь, а не падают при приведении к Int64
+    numbers = {}
+    for column in IMPORT_INTEGER_COLUMNS & texts.keys():
+        values = pd.to_numeric(texts[column], errors='coerce')
+        integral = values.notna() & (values % 1 == 0) & (values.abs() <= INTEGER_MAX)
+        reject((texts[column] != '') & ~integral, column, "Значение должно быть целым числом")
+        numbers[column] = values.where(integral)
+    if "quantity" in texts:
+        reject(numbers["quantity"].notna() & ~(numbers["quantity"] > 0), "quantity", "Количество должно быть больше 0")
+    for column, ref_table in IMPORT_FOREIGN_KEYS.get(table, {}).items():
+        if column not in texts:
+            continue
+        ids = numbers[column]
+        if known_ids is not None and ref_table in known_ids:
+            reject(ids.notna() & ~ids.isin(known_ids[ref_table]), column, f"Нет записи с таким id в таблице {ref_table}")
+    if not reports:
+        return pd.DataFrame(columns=["row", "column", "error"])
+    return pd.concat(reports, ignore_index=True).sort_values("row", kind="stable", ignore_index=True)
+
 def validate_medication_data(name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code):
     errors = []
     if not name:
         errors.append("Название не может быть пустым")
     if not gtin or len(gtin) > 20:
         errors.append("GTIN должен быть непустым и не длиннее 20 символов")
+    elif not gs1_check_digits_valid([gtin], GTIN_LENGTHS)[0]:
+        errors.append("GTIN имеет неверную длину или контрольную цифру")
     if not sku or len(sku) > 20:
         errors.append("SKU должен быть непустым и не длиннее 20 символов")
     if not market:
@@ -520,7 +1931,7 @@ def validate_medication_data(name, gtin, sku, market, batch_number, expiration_d
         errors.append("Объем/Размер упаковки обязателен")
     if not owned_by:
         errors.append("Компания-владелец обязательна")
-    if atc_code and not re.match(r'^[A-Z]{1,2}[0-9]{2}[A-Z]{0,2}[0-9]{0,2}$', atc_code):
+    if atc_code and not re.fullmatch(ATC_CODE_PATTERN, atc_code):
         errors.append("Код АТС имеет неверный формат (пример: A10BA02)")
     return errors
 
@@ -536,6 +1947,8 @@ def validate_company_data(gln, name_short, name_full, gcp_compliant, registratio
         errors.append("Полное название не должно превышать 100 символов")
     if gln and len(gln) > 20:
         errors.append("GLN не должен превышать 20 символов")
+    elif gln and not gs1_check_digits_valid([gln], GLN_LENGTHS)[0]:
+        errors.append("GLN должен состоять из 13 цифр с верной контрольной цифрой")
     if registration_country and len(registration_country) > 50:
         errors.append("Страна регистрации не должна превышать 50 символов")
     if address and len(address) > 200:
@@ -552,6 +1965,8 @@ def validate_location_data(gln, country, address, role, name_short, name_full, o
         errors.append("Адрес не должен превышать 200 символов")
     if gln and len(gln) > 20:
         errors.append("GLN не должен превышать 20 символов")
+    elif gln and not gs1_check_digits_valid([gln], GLN_LENGTHS)[0]:
+        errors.append("GLN должен состоять из 13 цифр с верной контрольной цифрой")
     if country and len(country) > 50:
         errors.append("Страна не должна превышать 50 символов")
     if role and len(role) > 50:
@@ -599,7 +2014,7 @@ def login(username, password):
         st.error(f"Ошибка базы данных: {e}")
         return False
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 # Интерфейс авторизации
 def auth_interface():
@@ -702,84 +2117,192 @@ def show_access_denied():
     st.markdown('</div>', unsafe_allow_html=True)
 
 # Интерфейс и страницы
+# Постраничный просмотр: страница читается по ключу (значение сортировки, id) с сортировкой на сервере,
+# следующая страница предзагружается в фоне
+VIEW_PAGE_SIZE = 100
+VIEW_DISPLAY_COLUMNS = {
+    "medicines": ['id', 'owned_by_name', 'name', 'gtin', 'sku', 'atc_code', 'market', 'shared', 'batch_number', 'expiration_date', 'dosage_form', 'active_ingredient', 'package_size', 'created_date'],
+    "companies": ['id', 'gln', 'name_short', 'name_full', 'gcp_compliant', 'registration_country', 'address', 'type'],
+    "locations": ['id', 'owned_by_name', 'gln', 'country', 'address', 'role', 'name_short', 'name_full', 'created_date'],
+    "operations": ['id', 'medicine_name', 'location_name', 'operation_type', 'operation_date', 'quantity', 'created_date'],
+}
+# Сортировка доступна только по столбцам с подходящим индексом: на каждый такой столбец приходится индекс,
+# который обновляется при каждой записи. Столбцы присоединённых таблиц индексом просматриваемой таблицы не отсортировать
+VIEW_SORT_COLUMNS = {
+    "medicines": ['id', 'name', 'gtin'],
+    "companies": ['id', 'name_short', 'name_full'],
+    "locations": ['id', 'name_short', 'country'],
+    "operations": ['id', 'operation_date'],
+}
+# Обязательные при любой записи (форма и импорт) столбцы сортируются как есть, по уже существующему индексу столбца
+VIEW_RAW_SORT_COLUMNS = {'operation_date'}
+VIEW_SORT_INDEX_MIGRATION_TABLES = ("companies", "locations")
+ENTITY_TABLES = {"Препараты": "medicines", "Компании": "companies", "Локации": "locations", "Операции": "operations"}
+
+def view_sort_expression(column):
+    # NULL заменяется крайним значением, чтобы сравнение ключа страницы (значение, id) было определено.
+    # Для каждого сортируемого столбца есть индекс по тому же выражению и id (миграция 16 и create-sort-indexes)
+    if column == 'id' or column in VIEW_RAW_SORT_COLUMNS:
+        return column
+    if column in DATE_COLUMNS:
+        return f"COALESCE({column}, '-infinity')"
+    if column in FILTER_NUMBER_COLUMNS:
+        return f"COALESCE({column}, -2147483648)"
+    return f"COALESCE({column}, '')"
+
+def build_page_query(table, columns, sort_column, descending, after=None, limit=VIEW_PAGE_SIZE):
+    direction, operator = ("DESC", "<") if descending else ("ASC", ">")
+    where = ""
+    params = []
+    if sort_column == 'id':
+        if after is not None:
+            where = f" WHERE id {operator} %s"
+            params.append(after[1])
+        query = f"SELECT {', '.join(columns)}, id AS sort_key FROM {table}{where} ORDER BY id {direction} LIMIT %s"
+        return query, tuple(params + [limit])
+    sort_expression = view_sort_expression(sort_column)
+    # Даты возвращаются текстом: '-infinity' не представим в Python
+    sort_key = f"{sort_expression}::text" if sort_column in DATE_COLUMNS else sort_expression
+    key_placeholder = "%s::timestamp" if sort_column in DATE_COLUMNS else "%s"
+    if after is not None:
+        where = f" WHERE ({sort_expression}, id) {operator} ({key_placeholder}, %s)"
+        params.extend(after)
+        if sort_column in VIEW_RAW_SORT_COLUMNS:
+            # Индекс только по столбцу: отдельное условие задаёт начало диапазона, id досортировывается внутри значения
+            where += f" AND {sort_column} {operator}= {key_placeholder}"
+            params.append(after[0])
+    query = (f"SELECT {', '.join(columns)}, {sort_key} AS sort_key FROM {table}{where} "
+             f"ORDER BY {sort_expression} {direction}, id {direction} LIMIT %s")
+    return query, tuple(params + [limit])
+
+def page_end_key(page):
+    sort_key = page['sort_key'].iloc[-1]
+    return (sort_key.item() if hasattr(sort_key, 'item') else sort_key, int(page['id'].iloc[-1]))
+
+def fetch_view_page(table, sort_column, descending, after):
+    view = DISPLAY_VIEWS[table]
+    dependencies = VIEW_DEPENDENCIES[view]
+    query, params = build_page_query(view, VIEW_DISPLAY_COLUMNS[table], sort_column, descending, after, VIEW_PAGE_SIZE + 1)
+    wait_prefetched(dependencies, query, params)
+    page = read_query(dependencies, query, params)
+    has_next_page = len(page) > VIEW_PAGE_SIZE
+    page = page.head(VIEW_PAGE_SIZE)
+    if has_next_page:
+        prefetch_query(dependencies, *build_page_query(view, VIEW_DISPLAY_COLUMNS[table], sort_column, descending, page_end_key(page), VIEW_PAGE_SIZE + 1))
+    return page, has_next_page
+
+# Сводная статистика считается агрегатными запросами в базе и кэшируется до изменения таблицы
+STATS_NUMERIC_COLUMNS = {
+    "medicines": ['id'],
+    "companies": ['id'],
+    "locations": ['id'],
+    "operations": ['id', 'quantity'],
+}
+STATS_CATEGORICAL_COLUMNS = {
+    "medicines": ['name', 'gtin', 'sku', 'atc_code', 'market', 'shared', 'batch_number', 'dosage_form', 'active_ingredient', 'package_size'],
+    "companies": ['gln', 'name_short', 'name_full', 'gcp_compliant', 'registration_country', 'address', 'type'],
+    "locations": ['gln', 'country', 'address', 'role', 'name_short', 'name_full'],
+    "operations": ['operation_type'],
+}
+STATS_SAMPLE_PERCENTS = [1, 5, 10, 25]
+
+def stats_source(table, sample_percent=None):
+    # TABLESAMPLE SYSTEM читает случайные страницы таблицы, а не все строки;
+    # REPEATABLE даёт одну и ту же выборку во всех подзапросах
+    if sample_percent:
+        return f"{table} TABLESAMPLE SYSTEM (%s) REPEATABLE (0)", [sample_percent]
+    return table, []
+
+def get_numeric_statistics(table, sample_percent=None):
+    columns = STATS_NUMERIC_COLUMNS[table]
+    source, params = stats_source(table, sample_percent)
+    aggregates = []
+    for col in columns:
+        aggregates.extend([
+            f"count({col}) AS {col}__count", f"avg({col}) AS {col}__mean", f"stddev_samp({col}) AS {col}__std",
+            f"min({col}) AS {col}__min",
+            f"percentile_cont(0.25) WITHIN GROUP (ORDER BY {col}) AS {col}__p25",
+            f"percentile_cont(0.5) WITHIN GROUP (ORDER BY {col}) AS {col}__p50",
+            f"percentile_cont(0.75) WITHIN GROUP (ORDER BY {col}) AS {col}__p75",
+            f"max({col}) AS {col}__max",
+        ])
+    result = read_query((table,), f"SELECT {', '.join(aggregates)} FROM {source}", tuple(params))
+    if result.empty:
+        return pd.DataFrame()
+    # Строки в том же порядке и с теми же названиями, что у DataFrame.describe()
+    labels = {'count': 'count', 'mean': 'mean', 'std': 'std', 'min': 'min', 'p25': '25%', 'p50': '50%', 'p75': '75%', 'max': 'max'}
+    stats = {col: {label: result[f"{col}__{stat}"].iloc[0] for stat, label in labels.items()} for col in columns}
+    return pd.DataFrame(stats).astype(float)
+
+def get_categorical_statistics(table, sample_percent=None):
+    columns = STATS_CATEGORICAL_COLUMNS[table]
+    source, params = stats_source(table, sample_percent)
+    counts = read_query((table,), f"SELECT {', '.join(f'count({col}) AS {col}__count, count(DISTINCT {col}) AS {col}__unique' for col in columns)} FROM {source}", tuple(params))
+    top_queries = [f"(SELECT '{col}' AS column_name, {col}::text AS top, count(*) AS freq FROM {source} WHERE {col} IS NOT NULL GROUP BY {col} ORDER BY freq DESC LIMIT 1)" for col in columns]
+    tops = read_query((table,), " UNION ALL ".join(top_queries), tuple(params * len(columns)))
+    if counts.empty:
+        return pd.DataFrame()
+    tops = tops.set_index('column_name') if not tops.empty else pd.DataFrame(columns=['top', 'freq'])
+    stats = {col: {"count": counts[f"{col}__count"].iloc[0], "unique": counts[f"{col}__unique"].iloc[0],
+                   "top": tops['top'].get(col), "freq": tops['freq'].get(col)} for col in columns}
+    return pd.DataFrame(stats)
+
 def show_view_data():
     st.subheader("Просмотр данных")
     entity = st.selectbox("Выберите тип данных", ["Препараты", "Компании", "Локации", "Операции"])
-    
-    if entity == "Препараты":
-        df = get_medications()
-        companies = get_companies()
-        if not df.empty:
-            if not companies.empty:
-                # Merge с явным указанием суффиксов для избежания конфликтов
-                df = df.merge(companies[['id', 'name_full']], left_on='owned_by', right_on='id', how='left', suffixes=('', '_company'))
-                df = df.rename(columns={'name_full': 'owned_by_name'})
-                # Удаляем только owned_by и id_company (если есть)
-                display_df = df.drop(columns=['owned_by', 'id_company'], errors='ignore')
-            else:
-                # Если companies пустой, создаём owned_by_name с None
-                df['owned_by_name'] = None
-                display_df = df.drop(columns=['owned_by'], errors='ignore')
-            # Проверяем наличие столбцов перед выбором
-            available_columns = [col for col in ['id', 'owned_by_name', 'name', 'gtin', 'sku', 'atc_code', 'market', 'shared', 'batch_number', 'expiration_date', 'dosage_form', 'active_ingredient', 'package_size', 'created_date'] if col in display_df.columns]
-            display_df = display_df[available_columns]
-        else:
-            display_df = df
-    elif entity == "Компании":
-        display_df = get_companies()
-    elif entity == "Локации":
-        df = get_locations()
-        companies = get_companies()
-        if not df.empty:
-            if not companies.empty:
-                df = df.merge(companies[['id', 'name_full']], left_on='owned_by', right_on='id', how='left', suffixes=('', '_company'))
-                df = df.rename(columns={'name_full': 'owned_by_name'})
-                display_df = df.drop(columns=['owned_by', 'id_company'], errors='ignore')
-            else:
-                df['owned_by_name'] = None
-                display_df = df.drop(columns=['owned_by'], errors='ignore')
-            available_columns = [col for col in ['id', 'owned_by_name', 'gln', 'country', 'address', 'role', 'name_short', 'name_full', 'created_date'] if col in display_df.columns]
-            display_df = display_df[available_columns]
-        else:
-            display_df = df
-    else:  # Операции
-        df = get_operations()
-        medicines = get_medications()
-        locations = get_locations()
-        if not df.empty:
-            if not medicines.empty:
-                df = df.merge(medicines[['id', 'name']], left_on='medicine_id', right_on='id', how='left', suffixes=('', '_med'))
-                df = df.rename(columns={'name': 'medicine_name'})
-            else:
-                df['medicine_name'] = None
-            if not locations.empty:
-                df = df.merge(locations[['id', 'name_short']], left_on='location_id', right_on='id', how='left', suffixes=('', '_loc'))
-                df = df.rename(columns={'name_short': 'location_name'})
-            else:
-                df['location_name'] = None
-            display_df = df.drop(columns=['medicine_id', 'location_id', 'id_med', 'id_loc'], errors='ignore')
-            available_columns = [col for col in ['id', 'medicine_name', 'location_name', 'operation_type', 'operation_date', 'quantity', 'created_date'] if col in display_df.columns]
-            display_df = display_df[available_columns]
-        else:
-            display_df = df
+    table = ENTITY_TABLES[entity]
+    sortable_columns = VIEW_SORT_COLUMNS[table]
+    sort_col, order_col = st.columns(2)
+    sort_column = sort_col.selectbox("Сортировка", sortable_columns)
+    descending = order_col.radio("Порядок", ["По возрастанию", "По убыванию"], horizontal=True) == "По убыванию"
 
-    if not display_df.empty:
+    # Стек ключей начала страниц сбрасывается при смене таблицы или сортировки
+    view_key = (table, sort_column, descending)
+    if st.session_state.get('view_key') != view_key:
+        st.session_state['view_key'] = view_key
+        st.session_state['view_page_starts'] = [None]
+    page_starts = st.session_state['view_page_starts']
+    page, has_next_page = fetch_view_page(table, sort_column, descending, page_starts[-1])
+
+    if not page.empty:
+        display_df = page[VIEW_DISPLAY_COLUMNS[table]]
         st.write("### Данные")
-        st.dataframe(display_df)
+        st.dataframe(display_df, hide_index=True)
+        prev_col, page_col, next_col = st.columns([1, 2, 1])
+        page_col.write(f"Страница {len(page_starts)}")
+        if prev_col.button("← Назад", disabled=len(page_starts) == 1):
+            page_starts.pop()
+            st.rerun()
+        if next_col.button("Далее →", disabled=not has_next_page):
+            page_starts.append(page_end_key(page))
+            st.rerun()
+        approximate = st.checkbox("Приблизительная статистика по выборке (для больших таблиц)")
+        sample_percent = st.select_slider("Размер выборки, %", options=STATS_SAMPLE_PERCENTS, value=5) if approximate else None
         st.write("### Числовая статистика")
-        numeric_df = display_df.select_dtypes(include=['int64', 'float64'])
-        if not numeric_df.empty:
-            st.dataframe(numeric_df.describe())
+        if sample_percent:
+            st.caption(f"Оценка по выборке ~{sample_percent}% страниц таблицы")
+        numeric_stats = get_numeric_statistics(table, sample_percent)
+        if not numeric_stats.empty:
+            st.dataframe(numeric_stats)
         else:
             st.info("Нет числовых данных для статистики.")
         st.write("### Категориальная статистика")
-        categorical_df = display_df.select_dtypes(include=['object', 'bool'])
-        if not categorical_df.empty:
-            st.dataframe(categorical_df.describe())
+        categorical_stats = get_categorical_statistics(table, sample_percent)
+        if not categorical_stats.empty:
+            st.dataframe(categorical_stats)
         else:
             st.info("Нет категориальных данных для статистики.")
-        if st.button("Экспорт", key=f"export_{entity.lower()}_data"):
-            export_data(entity.lower())
+        formats = export_formats()
+        export_format = st.selectbox("Формат экспорта", list(formats.keys()), key=f"export_{table}_format")
+        export_in_background = st.checkbox("Экспорт в фоне", key=f"export_{table}_background", help="Файл будет доступен на странице 'Задачи'")
+        if st.button("Экспорт", key=f"export_{table}_data"):
+            if export_in_background:
+                job_id = submit_job("export", {"table": DISPLAY_VIEWS[table], "columns": VIEW_DISPLAY_COLUMNS[table], "format": formats[export_format]},
+                                    st.session_state['username'])
+                if job_id:
+                    st.success(f"Экспорт поставлен в очередь: задача #{job_id}")
+            else:
+                export_data(DISPLAY_VIEWS[table], VIEW_DISPLAY_COLUMNS[table], formats[export_format])
     else:
         st.warning(f"Нет данных для отображения. Добавьте {entity.lower()} на странице 'Добавить'.")
 
@@ -938,7 +2461,7 @@ def show_edit_delete_data():
             st.error(f"Ошибка редактирования: {e}")
             log_action("Edit error", f"Entity: {entity}, ID: {record_id}, Error: {str(e)}", st.session_state['username'])
         finally:
-            conn.close()
+            release_db_connection(conn)
 
 def show_add_data():
     st.subheader("Добавить новую запись")
@@ -968,19 +2491,20 @@ def show_add_data():
                     for error in errors:
                         st.error(error)
                 else:
-                    conn = get_db_connection()
-                    if conn:
-                        c = conn.cursor()
-                        c.execute('''SELECT id FROM medicines 
-                                    WHERE name = %s AND gtin = %s AND sku = %s AND market = %s 
-                                    AND batch_number = %s AND expiration_date = %s AND dosage_form = %s 
-                                    AND active_ingredient = %s AND package_size = %s AND owned_by = %s AND atc_code = %s''',
-                                (name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code))
-                        if c.fetchone():
+                    # Соединение возвращается в пул и при ошибке запроса
+                    try:
+                        with get_db_pool().connection() as conn:
+                            exists = conn.execute('''SELECT id FROM medicines 
+                                        WHERE name = %s AND gtin = %s AND sku = %s AND market = %s 
+                                        AND batch_number = %s AND expiration_date = %s AND dosage_form = %s 
+                                        AND active_ingredient = %s AND package_size = %s AND owned_by = %s AND atc_code = %s''',
+                                    (name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code)).fetchone()
+                    except psycopg.Error as e:
+                        st.error(f"Ошибка базы данных: {e}")
+                    else:
+                        if exists:
                             st.error("Такая запись уже существует")
-                            conn.close()
                         else:
-                            conn.close()
                             add_medication(name, gtin, sku, market, batch_number, expiration_date, dosage_form, active_ingredient, package_size, owned_by, atc_code, st.session_state['username'])
                             st.success("Препарат добавлен!")
     elif entity == "Компании":
@@ -1001,19 +2525,19 @@ def show_add_data():
                     for error in errors:
                         st.error(error)
                 else:
-                    conn = get_db_connection()
-                    if conn:
-                        c = conn.cursor()
-                        c.execute('''SELECT id FROM companies 
-                                     WHERE gln = %s AND name_short = %s AND name_full = %s 
-                                     AND gcp_compliant = %s AND registration_country = %s 
-                                     AND address = %s AND type = %s''',
-                                  (gln, name_short, name_full, gcp_compliant, registration_country, address, type))
-                        if c.fetchone():
+                    try:
+                        with get_db_pool().connection() as conn:
+                            exists = conn.execute('''SELECT id FROM companies 
+                                         WHERE gln = %s AND name_short = %s AND name_full = %s 
+                                         AND gcp_compliant = %s AND registration_country = %s 
+                                         AND address = %s AND type = %s''',
+                                      (gln, name_short, name_full, gcp_compliant, registration_country, address, type)).fetchone()
+                    except psycopg.Error as e:
+                        st.error(f"Ошибка базы данных: {e}")
+                    else:
+                        if exists:
                             st.error("Такая запись уже существует")
-                            conn.close()
                         else:
-                            conn.close()
                             add_company(gln, name_short, name_full, gcp_compliant, registration_country, address, type, st.session_state['username'])
                             st.success("Компания добавлена!")
     elif entity == "Локации":
@@ -1064,11 +2588,88 @@ def show_add_data():
                     add_operation(medicine_id, location_id, operation_type, operation_date, quantity, st.session_state['username'])
                     st.success("Операция добавлена!")
 
+# Фильтрация выполняется в базе: выбранные фильтры собираются в параметризованный WHERE,
+# а результат читается постранично по id (keyset), без загрузки таблицы целиком
+FILTER_TEXT_COLUMNS = {"name", "gtin", "sku", "market", "batch_number", "address", "gln", "country", "role", "name_short", "name_full", "registration_country", "type", "operation_type", "dosage_form", "active_ingredient", "package_size", "atc_code"}
+FILTER_DATE_COLUMNS = {"expiration_date", "operation_date", "created_date"}
+FILTER_NUMBER_COLUMNS = {"quantity", "medicine_id", "location_id", "owned_by"}
+FILTER_PAGE_SIZE = 100
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def build_filter_conditions(filter_values):
+    conditions = []
+    params = []
+    for param, value in filter_values.items():
+        if param in FILTER_TEXT_COLUMNS:
+            if value:
+                conditions.append(f"{param} ILIKE %s")
+                params.append(f"%{escape_like(value)}%")
+        elif param in FILTER_DATE_COLUMNS:
+            date_from, date_to = value
+            conditions.append(f"{param} >= %s AND {param} < %s")
+            params.extend([date_from, date_to + timedelta(days=1)])
+        elif param in FILTER_NUMBER_COLUMNS:
+            conditions.append(f"{param} = %s")
+            params.append(int(value))
+        elif param == "gcp_compliant":
+            if value != "Любое":
+                conditions.append("gcp_compliant = %s")
+                params.append(value == "Да")
+    return conditions, params
+
+def build_filter_query(table, filter_values, after_id=None, limit=FILTER_PAGE_SIZE):
+    conditions, params = build_filter_conditions(filter_values)
+    if after_id is not None:
+        conditions.append("id > %s")
+        params.append(after_id)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT * FROM {DISPLAY_VIEWS[table]}{where} ORDER BY id LIMIT %s", tuple(params + [limit])
+
+# Поиск по каталогу: препараты, компании и локации одним запросом с ранжированием по сходству
+SEARCH_TITLE_COLUMNS = {"medicines": "name", "companies": "name_full", "locations": "COALESCE(name_full, name_short, address)"}
+SEARCH_MIN_LENGTH = 3  # Триграммный индекс работает для запросов от трёх символов
+SEARCH_RESULT_LIMIT = 50
+TABLE_TITLES = {"medicines": "Препараты", "companies": "Компании", "locations": "Локации", "operations": "Операции"}
+
+def search_catalog(text, limit=SEARCH_RESULT_LIMIT):
+    pattern = f"%{escape_like(text)}%"
+    parts = []
+    params = []
+    for table, columns in SEARCH_COLUMNS.items():
+        rank = ", ".join(f"word_similarity(%s, COALESCE({col}, ''))" for col in columns)
+        match = " OR ".join(f"{col} ILIKE %s" for col in columns)
+        parts.append(f"(SELECT '{table}' AS source, id, {SEARCH_TITLE_COLUMNS[table]} AS title, GREATEST({rank}) AS rank "
+                     f"FROM {table} WHERE {match} ORDER BY rank DESC LIMIT %s)")
+        params.extend([text] * len(columns) + [pattern] * len(columns) + [limit])
+    query = f"SELECT * FROM ({' UNION ALL '.join(parts)}) found ORDER BY rank DESC, source, id LIMIT %s"
+    return read_query(tuple(SEARCH_COLUMNS), query, tuple(params + [limit]))
+
+def show_catalog_search():
+    text = st.text_input("Поиск по препаратам, компаниям и локациям", placeholder="Название, действующее вещество или адрес")
+    if not text:
+        return
+    if len(text.strip()) < SEARCH_MIN_LENGTH:
+        st.info(f"Введите не меньше {SEARCH_MIN_LENGTH} символов.")
+        return
+    found = search_catalog(text.strip())
+    if found.empty:
+        st.warning("Ничего не найдено.")
+        return
+    found['source'] = found['source'].map(TABLE_TITLES)
+    st.dataframe(found.rename(columns={"source": "Раздел", "id": "ID", "title": "Название", "rank": "Сходство"}), hide_index=True)
+
+def table_has_rows(table):
+    result = read_query((table,), f"SELECT EXISTS (SELECT 1 FROM {table}) AS has_rows")
+    return not result.empty and bool(result['has_rows'].iloc[0])
+
 def show_filter_data():
     st.subheader("Фильтрация")
+    show_catalog_search()
     entity = st.selectbox("Выберите тип данных", ["Препараты", "Компании", "Локации", "Операции"])
     if entity == "Препараты":
-        df = get_medications()
+        table = "medicines"
         filter_options = {
             "name": "Название",
             "gtin": "GTIN",
@@ -1084,7 +2685,7 @@ def show_filter_data():
             "owned_by": "ID компании-владельца"
         }
     elif entity == "Компании":
-        df = get_companies()
+        table = "companies"
         filter_options = {
             "gln": "GLN",
             "name_short": "Краткое название",
@@ -1095,7 +2696,7 @@ def show_filter_data():
             "type": "Тип"
         }
     elif entity == "Локации":
-        df = get_locations()
+        table = "locations"
         filter_options = {
             "gln": "GLN",
             "country": "Страна",
@@ -1107,7 +2708,7 @@ def show_filter_data():
             "created_date": "Дата создания"
         }
     else:
-        df = get_operations()
+        table = "operations"
         filter_options = {
             "medicine_id": "ID Препарата",
             "location_id": "ID локации",
@@ -1116,7 +2717,7 @@ def show_filter_data():
             "quantity": "Количество",
             "created_date": "Дата создания"
         }
-    if df.empty:
+    if not table_has_rows(table):
         st.warning(f"Нет данных для фильтрации. Добавьте {entity.lower()} на странице 'Добавить'.")
         return
     selected_filters = st.multiselect(
@@ -1129,42 +2730,227 @@ def show_filter_data():
         return
     filter_values = {}
     for param in selected_filters:
-        if param in ["name", "gtin", "sku", "market", "batch_number", "address", "gln", "country", "role", "name_short", "name_full", "registration_country", "type", "operation_type", "dosage_form", "active_ingredient", "package_size"]:
+        if param in FILTER_TEXT_COLUMNS:
             filter_values[param] = st.text_input(f"Введите {filter_options[param]} (или оставьте пустым)")
-        elif param in ["expiration_date", "operation_date", "created_date"]:
-            filter_values[param] = st.date_input(f"Выберите {filter_options[param]}")
-        elif param in ["quantity", "medicine_id", "location_id", "owned_by"]:
+        elif param in FILTER_DATE_COLUMNS:
+            selected_dates = st.date_input(f"Выберите период: {filter_options[param]}", value=(date.today(), date.today()))
+            # Пока выбрана только начальная дата периода, фильтруем по одному дню
+            filter_values[param] = (selected_dates[0], selected_dates[-1]) if selected_dates else (date.today(), date.today())
+        elif param in FILTER_NUMBER_COLUMNS:
             filter_values[param] = st.number_input(f"Введите {filter_options[param]}", step=1)
         elif param == "gcp_compliant":
             filter_values[param] = st.selectbox(f"Выберите {filter_options[param]}", ["Любое", "Да", "Нет"])
 
     if st.button("Применить фильтр"):
-        filtered_df = df.copy()
-        for param in selected_filters:
-            if param in ["name", "gtin", "sku", "market", "batch_number", "address", "gln", "country", "role", "name_short", "name_full", "registration_country", "type", "operation_type", "dosage_form", "active_ingredient", "package_size"]:
-                if filter_values[param]:
-                    filtered_df = filtered_df[filtered_df[param].str.contains(filter_values[param], case=False, na=False)]
-            elif param in ["expiration_date", "operation_date", "created_date"]:
-                filtered_df = filtered_df[filtered_df[param].astype(str).str.startswith(str(filter_values[param]), na=False)]
-            elif param in ["quantity", "medicine_id", "location_id", "owned_by"]:
-                filtered_df = filtered_df[filtered_df[param] == filter_values[param]]
-            elif param == "gcp_compliant":
-                if filter_values[param] != "Любое":
-                    filtered_df = filtered_df[filtered_df[param] == (filter_values[param] == "Да")]
-        if filtered_df.empty:
-            st.warning("Нет данных, соответствующих выбранным фильтрам.")
-        else:
-            st.subheader("Отфильтрованные данные")
-            st.dataframe(filtered_df)
+        # Применённый фильтр и стек начальных id страниц переживают перезапуски скрипта при листании
+        st.session_state['applied_filter'] = (table, filter_values)
+        st.session_state['filter_page_starts'] = [None]
+    applied = st.session_state.get('applied_filter')
+    if not applied or applied[0] != table:
+        return
+    page_starts = st.session_state['filter_page_starts']
+    query, params = build_filter_query(table, applied[1], after_id=page_starts[-1], limit=FILTER_PAGE_SIZE + 1)
+    filtered_df = read_query(VIEW_DEPENDENCIES[DISPLAY_VIEWS[table]], query, params)
+    has_next_page = len(filtered_df) > FILTER_PAGE_SIZE
+    filtered_df = filtered_df.head(FILTER_PAGE_SIZE)
+    if filtered_df.empty:
+        st.warning("Нет данных, соответствующих выбранным фильтрам.")
+        return
+    st.subheader("Отфильтрованные данные")
+    st.dataframe(filtered_df)
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    page_col.write(f"Страница {len(page_starts)}")
+    if prev_col.button("← Назад", disabled=len(page_starts) == 1):
+        page_starts.pop()
+        st.rerun()
+    if next_col.button("Далее →", disabled=not has_next_page):
+        page_starts.append(int(filtered_df['id'].iloc[-1]))
+        st.rerun()
+
+# Данные для графиков агрегируются в базе: в браузер уходят только пары (категория, количество)
+CHART_TOP_N = 20
+CHART_OTHER_LABEL = "Другое"
+CHART_LEGEND = dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1)
+
+def column_counts_query(table, column, missing_label="Не указано"):
+    return f"SELECT COALESCE({column}::text, '{missing_label}') AS category, count(*) AS count FROM {table} GROUP BY 1"
+
+def get_top_categories(dependencies, grouped_query, params=(), top_n=CHART_TOP_N):
+    # grouped_query возвращает (category, count); категории за пределами top_n сворачиваются в одну
+    query = f'''WITH grouped AS ({grouped_query}),
+        ranked AS (SELECT category, count, row_number() OVER (ORDER BY count DESC, category) AS position FROM grouped)
+        SELECT category, count FROM ranked WHERE position <= %s
+        UNION ALL
+        SELECT %s, sum(count) FROM ranked WHERE position > %s HAVING count(*) > 0'''
+    return read_query(dependencies, query, tuple(params) + (top_n, CHART_OTHER_LABEL, top_n))
+
+# Сроки годности: границы корзин в днях от текущей даты, верхняя граница включительно (как у прежнего pd.cut)
+EXPIRY_BUCKETS = [("Просрочено", 0), ("Менее 6 мес.", 180), ("6-12 мес.", 365), ("Более года", None)]
+EXPIRY_ALERT_DAYS = int(os.environ.get("PHARMA_EXPIRY_ALERT_DAYS", 180))
+EXPIRY_ALERT_CHECK_SECONDS = 3600
+EXPIRY_ALERT_LOCK_ID = 7305002  # Отчёт строит одна реплика, остальные пропускают запуск
+
+def get_expiry_buckets(today):
+    # Каждая корзина — отдельный подсчёт по диапазону индекса idx_medicines_expiration_date, без чтения строк таблицы
+    parts, params = [], []
+    lower = None
+    for label, upper_days in EXPIRY_BUCKETS:
+        conditions, bounds = ["expiration_date IS NOT NULL"], []
+        if lower is not None:
+            conditions.append("expiration_date > %s")
+            bounds.append(today + timedelta(days=lower))
+        if upper_days is not None:
+            conditions.append("expiration_date <= %s")
+            bounds.append(today + timedelta(days=upper_days))
+        parts.append(f"SELECT %s AS category, (SELECT count(*) FROM medicines WHERE {' AND '.join(conditions)}) AS count")
+        params += [label] + bounds
+        lower = upper_days
+    return read_query(("medicines",), " UNION ALL ".join(parts), tuple(params))
+
+def generate_expiry_alerts(c, today, days=EXPIRY_ALERT_DAYS):
+    # Список пересобирается целиком: препараты со сроком до today + days по каждой локации, где есть остаток.
+    # Просроченные препараты попадают в список, только пока они лежат на складе.
+    c.execute("DELETE FROM expiry_alerts")
+    c.execute('''INSERT INTO expiry_alerts (generated_on, medicine_id, company_id, location_id, expiration_date, days_left, quantity)
+                 SELECT %(today)s, m.id, m.owned_by, NULLIF(b.location_id, 0), m.expiration_date, m.expiration_date - %(today)s, b.quantity
+                 FROM medicines m
+                 LEFT JOIN stock_balances b ON b.medicine_id = m.id AND b.quantity > 0
+                 WHERE m.expiration_date <= %(horizon)s
+                   AND (m.expiration_date > %(today)s OR b.quantity IS NOT NULL)''',
+              {"today": today, "horizon": today + timedelta(days=days)})
+    rows = c.rowcount
+    # Таблица заполняется не триггером, поэтому остальные реплики оповещаются явно
+    c.execute("SELECT pg_notify(%s, %s)", (CHANGE_NOTIFY_CHANNEL, json.dumps({"table": "expiry_alerts"})))
+    return rows
+
+def run_expiry_alert_job(force=False):
+    # Выполняется и в фоновом потоке, поэтому ошибки пишутся в лог, а не через st.error
+    try:
+        conn = get_db_pool().getconn()
+    except psycopg.Error as e:
+        log_action("Expiry alert job failed", f"Database unavailable: {e}")
+        return None
+    c = conn.cursor()
+    try:
+        today = date.today()
+        c.execute("SELECT pg_try_advisory_xact_lock(%s)", (EXPIRY_ALERT_LOCK_ID,))
+        if not c.fetchone()[0]:
+            conn.rollback()
+            return None
+        c.execute("SELECT max(generated_on) FROM expiry_alerts")
+        if not force and c.fetchone()[0] == today:
+            conn.rollback()
+            return None
+        rows = generate_expiry_alerts(c, today)
+        conn.commit()
+        invalidate_tables("expiry_alerts")
+        log_action("Generated expiry alerts", f"Date: {today}, rows: {rows}")
+        return rows
+    except psycopg.Error as e:
+        conn.rollback()
+        log_action("Expiry alert job failed", str(e))
+        return None
+    finally:
+        release_db_connection(conn)
+
+def _expiry_alert_loop():
+    while True:
+        try:
+            run_expiry_alert_job()
+        except Exception:
+            # Любая ошибка остаётся в логе, а поток продолжает проверки
+            logging.exception("Expiry alert job failed")
+        time.sleep(EXPIRY_ALERT_CHECK_SECONDS)
+
+@st.cache_resource
+def start_expiry_alert_job():
+    # Раз в час проверяет, построен ли список на сегодня; сам список строится раз в сутки
+    job = threading.Thread(target=_expiry_alert_loop, name="pharma-expiry-alerts", daemon=True)
+    job.start()
+    return job
+
+EXPIRY_ALERT_DEPENDENCIES = ("expiry_alerts", "medicines", "companies", "locations")
+
+def get_expiry_alerts(company_id=None):
+    condition = "WHERE a.company_id = %(company_id)s" if company_id is not None else ""
+    query = f'''SELECT a.generated_on, a.company_id, c.name_full AS company_name, a.location_id, l.name_short AS location_name,
+                      a.medicine_id, m.name AS medicine_name, m.batch_number, a.expiration_date, a.days_left, a.quantity
+               FROM expiry_alerts a
+               JOIN medicines m ON m.id = a.medicine_id
+               LEFT JOIN companies c ON c.id = a.company_id
+               LEFT JOIN locations l ON l.id = a.location_id
+               {condition}
+               ORDER BY a.days_left, c.name_full, l.name_short'''
+    return read_query(EXPIRY_ALERT_DEPENDENCIES, query, {"company_id": company_id})
+
+EXPIRY_ALERT_COLUMN_TITLES = {"generated_on": "Дата отчета", "company_id": "ID компании", "company_name": "Компания",
+                              "location_id": "ID локации", "location_name": "Локация", "medicine_id": "ID препарата",
+                              "medicine_name": "Препарат", "batch_number": "Серия", "expiration_date": "Срок годности",
+                              "days_left": "Осталось дней", "quantity": "Остаток", "medicines": "Препаратов"}
+
+def show_expiry_alerts():
+    alerts = get_expiry_alerts()
+    if alerts.empty:
+        st.info(f"Препаратов со сроком годности менее {EXPIRY_ALERT_DAYS} дней нет.")
+        return
+    st.write(f"Истекающие препараты (до {EXPIRY_ALERT_DAYS} дней), отчет от {alerts['generated_on'].iloc[0]}")
+    group = st.radio("Группировать по", ["Компаниям", "Локациям"], horizontal=True)
+    group_columns = ["company_id", "company_name"] if group == "Компаниям" else ["location_id", "location_name"]
+    summary = (alerts.groupby(group_columns, dropna=False)
+               .agg(medicines=("medicine_id", "nunique"), quantity=("quantity", "sum"), days_left=("days_left", "min"))
+               .reset_index().sort_values("days_left"))
+    st.dataframe(summary.rename(columns=EXPIRY_ALERT_COLUMN_TITLES), hide_index=True)
+    st.dataframe(alerts.rename(columns=EXPIRY_ALERT_COLUMN_TITLES), hide_index=True)
+    st.download_button("Скачать список (CSV)", data=alerts.rename(columns=EXPIRY_ALERT_COLUMN_TITLES).to_csv(index=False),
+                       file_name=f"expiry_alerts_{alerts['generated_on'].iloc[0]}.csv", mime="text/csv")
+
+# Временные ряды читаются из дневных итогов; неделя и месяц получаются date_trunc по дням
+ROLLUP_GRANULARITIES = {"День": "day", "Неделя": "week", "Месяц": "month"}
+
+def get_rollup_date_range():
+    bounds = read_query(("operations",), f"SELECT min(day) AS first_day, max(day) AS last_day FROM {OPERATIONS_ROLLUP_TABLE}")
+    if bounds.empty or pd.isna(bounds['first_day'].iloc[0]):
+        return None, None
+    return pd.Timestamp(bounds['first_day'].iloc[0]).date(), pd.Timestamp(bounds['last_day'].iloc[0]).date()
+
+def get_operations_series(start_day, end_day, granularity="day", operation_types=None, medicine_id=None, location_id=None):
+    conditions = ["day BETWEEN %s AND %s"]
+    params = [granularity, start_day, end_day]
+    if operation_types:
+        conditions.append("operation_type = ANY(%s)")
+        params.append(list(operation_types))
+    if medicine_id is not None:
+        conditions.append("medicine_id = %s")
+        params.append(medicine_id)
+    if location_id is not None:
+        conditions.append("location_id = %s")
+        params.append(location_id)
+    query = f'''SELECT date_trunc(%s, day)::date AS period, operation_type,
+                      sum(quantity_total) AS quantity, sum(operation_count) AS operations
+               FROM {OPERATIONS_ROLLUP_TABLE}
+               WHERE {" AND ".join(conditions)}
+               GROUP BY 1, 2 ORDER BY 1, 2'''
+    return read_query(("operations",), query, tuple(params))
+
+def show_bar_chart(data, title, x_title):
+    fig = px.bar(data, x='category', y='count', title=title, color='category')
+    fig.update_layout(xaxis_title=x_title, yaxis_title="Количество", showlegend=True, legend=CHART_LEGEND)
+    st.plotly_chart(fig)
+
+def show_pie_chart(data, title, legend_title):
+    fig = px.pie(data, names='category', values='count', title=title)
+    fig.update_layout(legend_title=legend_title, showlegend=True, legend=CHART_LEGEND)
+    st.plotly_chart(fig)
 
 def show_visualize():
     st.subheader("Визуализация данных")
     entity = st.selectbox("Выберите тип данных", ["Препараты", "Компании", "Локации", "Операции"])
+    table = ENTITY_TABLES[entity]
+    if not table_has_rows(table):
+        st.warning(f"Нет данных для визуализации. Добавьте {entity.lower()} на странице 'Добавить'.")
+        return
+    top_n = st.slider("Максимум категорий на графике (остальные — «Другое»)", min_value=5, max_value=50, value=CHART_TOP_N)
     if entity == "Препараты":
-        df = get_medications()
-        if df.empty:
-            st.warning("Нет данных для визуализации. Добавьте Препараты на странице 'Добавить'.")
-            return
         viz_type = st.selectbox("Тип визуализации", [
             "Распределение по рынкам",
             "Доля препаратов по сроку годности",
@@ -1172,105 +2958,39 @@ def show_visualize():
             "Препараты по размеру упаковки"
         ])
         if viz_type == "Распределение по рынкам":
-            if 'market' in df.columns:
-                fig = px.histogram(df, x='market', title="Распределение препаратов по рынкам", color='market')
-                fig.update_layout(xaxis_title="Рынок", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'market' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("medicines",), column_counts_query("medicines", "market"), top_n=top_n), "Распределение препаратов по рынкам", "Рынок")
         elif viz_type == "Доля препаратов по сроку годности":
-            if 'expiration_date' in df.columns:
-                current_date = pd.to_datetime("2025-05-21")
-                df['days_to_expiry'] = (pd.to_datetime(df['expiration_date']) - current_date).dt.days
-                df['expiry_status'] = pd.cut(df['days_to_expiry'],
-                                            bins=[-float('inf'), 0, 180, 365, float('inf')],
-                                            labels=['Просрочено', 'Менее 6 мес.', '6-12 мес.', 'Более года'])
-                fig = px.pie(df, names='expiry_status', title="Доля препаратов по сроку годности")
-                fig.update_layout(legend_title="Статус срока годности", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'expiration_date' отсутствует в данных.")
+            show_pie_chart(get_expiry_buckets(date.today()), "Доля препаратов по сроку годности", "Статус срока годности")
+            show_expiry_alerts()
         elif viz_type == "Распределение по формам выпуска":
-            if 'dosage_form' in df.columns:
-                fig = px.histogram(df, x='dosage_form', title="Распределение препаратов по формам выпуска", color='dosage_form')
-                fig.update_layout(xaxis_title="Форма выпуска", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'dosage_form' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("medicines",), column_counts_query("medicines", "dosage_form"), top_n=top_n), "Распределение препаратов по формам выпуска", "Форма выпуска")
         else:
-            if 'package_size' in df.columns:
-                fig = px.histogram(df, x='package_size', title="Препараты по размеру упаковки", color='package_size')
-                fig.update_layout(xaxis_title="Объем/Размер упаковки", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'package_size' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("medicines",), column_counts_query("medicines", "package_size"), top_n=top_n), "Препараты по размеру упаковки", "Объем/Размер упаковки")
     elif entity == "Компании":
-        df = get_companies()
-        if df.empty:
-            st.warning("Нет данных для визуализации. Добавьте компании на странице 'Добавить'.")
-            return
         viz_type = st.selectbox("Тип визуализации", [
             "Распределение по странам регистрации",
             "Доля по типам компаний",
             "Компании по GCP-совместимости"
         ])
         if viz_type == "Распределение по странам регистрации":
-            if 'registration_country' in df.columns:
-                fig = px.histogram(df, x='registration_country', title="Распределение компаний по странам регистрации", color='registration_country')
-                fig.update_layout(xaxis_title="Страна регистрации", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'registration_country' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("companies",), column_counts_query("companies", "registration_country"), top_n=top_n), "Распределение компаний по странам регистрации", "Страна регистрации")
         elif viz_type == "Доля по типам компаний":
-            if 'type' in df.columns:
-                fig = px.pie(df, names='type', title="Доля компаний по типам")
-                fig.update_layout(legend_title="Тип компании", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'type' отсутствует в данных.")
+            show_pie_chart(get_top_categories(("companies",), column_counts_query("companies", "type"), top_n=top_n), "Доля компаний по типам", "Тип компании")
         else:
-            if 'gcp_compliant' in df.columns:
-                fig = px.histogram(df, x='gcp_compliant', title="Компании по GCP-совместимости", color='gcp_compliant')
-                fig.update_layout(xaxis_title="GCP-совместимость", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'gcp_compliant' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("companies",), column_counts_query("companies", "gcp_compliant"), top_n=top_n), "Компании по GCP-совместимости", "GCP-совместимость")
     elif entity == "Локации":
-        df = get_locations()
-        if df.empty:
-            st.warning("Нет данных для визуализации. Добавьте локации на странице 'Добавить'.")
-            return
         viz_type = st.selectbox("Тип визуализации", [
             "Распределение по странам",
             "Распределение по ролям",
             "Локации по компаниям"
         ])
         if viz_type == "Распределение по странам":
-            if 'country' in df.columns:
-                fig = px.histogram(df, x='country', title="Распределение локаций по странам", color='country')
-                fig.update_layout(xaxis_title="Страна", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'country' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("locations",), column_counts_query("locations", "country"), top_n=top_n), "Распределение локаций по странам", "Страна")
         elif viz_type == "Распределение по ролям":
-            if 'role' in df.columns:
-                fig = px.histogram(df, x='role', title="Распределение локаций по ролям", color='role')
-                fig.update_layout(xaxis_title="Роль", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'role' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("locations",), column_counts_query("locations", "role"), top_n=top_n), "Распределение локаций по ролям", "Роль")
         else:
-            if 'owned_by' in df.columns:
-                fig = px.histogram(df, x='owned_by', title="Локации по компаниям", color='owned_by')
-                fig.update_layout(xaxis_title="ID компании", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'owned_by' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("locations",), column_counts_query("locations", "owned_by"), top_n=top_n), "Локации по компаниям", "ID компании")
     else:
-        df = get_operations()
-        if df.empty:
-            st.warning("Нет данных для визуализации. Добавьте операции на странице 'Добавить'.")
-            return
         viz_type = st.selectbox("Тип визуализации", [
             "Количество операций по датам",
             "Доля по типам операций",
@@ -1278,39 +2998,245 @@ def show_visualize():
             "Операции по Препаратам"
         ])
         if viz_type == "Количество операций по датам":
-            if 'operation_date' in df.columns and 'quantity' in df.columns:
-                df['operation_date'] = pd.to_datetime(df['operation_date'])
-                df_grouped = df.groupby(df['operation_date'].dt.date)['quantity'].sum().reset_index()
-                fig = px.line(df_grouped, x='operation_date', y='quantity', title="Количество операций по датам")
-                fig.update_layout(xaxis_title="Дата операции", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонки 'operation_date' или 'quantity' отсутствуют в данных.")
+            first_day, last_day = get_rollup_date_range()
+            if first_day is None:
+                st.warning("Нет операций с указанной датой.")
+                return
+            period = st.date_input("Период", value=(first_day, last_day), min_value=first_day, max_value=last_day)
+            granularity = st.radio("Шаг", list(ROLLUP_GRANULARITIES.keys()), horizontal=True)
+            by_type = st.checkbox("Разбить по типам операций")
+            if len(period) != 2:
+                st.info("Выберите начальную и конечную дату периода.")
+                return
+            series = get_operations_series(period[0], period[1], ROLLUP_GRANULARITIES[granularity])
+            if not by_type:
+                series = series.groupby('period', as_index=False)[['quantity', 'operations']].sum()
+            fig = px.line(series, x='period', y='quantity', color='operation_type' if by_type else None, title="Количество операций по датам")
+            fig.update_layout(xaxis_title="Дата операции", yaxis_title="Количество", showlegend=True, legend=CHART_LEGEND)
+            fig.update_xaxes(rangeslider_visible=True)
+            st.plotly_chart(fig)
         elif viz_type == "Доля по типам операций":
-            if 'operation_type' in df.columns:
-                fig = px.pie(df, names='operation_type', title="Доля операций по типам")
-                fig.update_layout(legend_title="Тип операции", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'operation_type' отсутствует в данных.")
+            show_pie_chart(get_top_categories(("operations",), column_counts_query("operations", "operation_type"), top_n=top_n), "Доля операций по типам", "Тип операции")
         elif viz_type == "Количество по типам операций":
-            if 'operation_type' in df.columns:
-                fig = px.histogram(df, x='operation_type', title="Количество по типам операций", color='operation_type')
-                fig.update_layout(xaxis_title="Тип операции", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'operation_type' отсутствует в данных.")
+            show_bar_chart(get_top_categories(("operations",), column_counts_query("operations", "operation_type"), top_n=top_n), "Количество по типам операций", "Тип операции")
         else:
-            if 'medicine_id' in df.columns:
-                # Объединяем с таблицей medicines, чтобы получить названия препаратов
-                medicines = get_medications()
-                df = df.merge(medicines[['id', 'name']], left_on='medicine_id', right_on='id', how='left')
-                df['medicine_name'] = df['name'].fillna('Не указан')
-                fig = px.histogram(df, x='medicine_name', title="Операции по Препаратам", color='medicine_name')
-                fig.update_layout(xaxis_title="Название препарата", yaxis_title="Количество", showlegend=True, legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1))
-                st.plotly_chart(fig)
-            else:
-                st.error("Колонка 'medicine_id' отсутствует в данных.")
+            # Сначала группировка по medicine_id (по индексу), затем подстановка названий для уже свёрнутых строк
+            grouped_query = '''SELECT COALESCE(m.name, 'Не указан') AS category, sum(o.count) AS count
+                               FROM (SELECT medicine_id, count(*) AS count FROM operations GROUP BY medicine_id) o
+                               LEFT JOIN medicines m ON m.id = o.medicine_id
+                               GROUP BY 1'''
+            show_bar_chart(get_top_categories(("operations", "medicines"), grouped_query, top_n=top_n), "Операции по Препаратам", "Название препарата")
+
+# Отчёт по препарату: данные загружаются адресными запросами, документ собирается отдельно от интерфейса,
+# чтобы его можно было строить в фоновой задаче
+def load_report_batch_data(conn, med_ids):
+    # Данные для пакета препаратов читаются четырьмя запросами и раскладываются по препаратам в памяти
+    params = (list(med_ids),)
+    medicines = pd.read_sql_query("SELECT * FROM medicines WHERE id = ANY(%s) ORDER BY id", conn, params=params)
+    companies = pd.read_sql_query("SELECT * FROM companies WHERE id IN (SELECT owned_by FROM medicines WHERE id = ANY(%s))", conn, params=params)
+    locations = pd.read_sql_query("SELECT * FROM locations WHERE id IN (SELECT location_id FROM operations WHERE medicine_id = ANY(%s)) ORDER BY id", conn, params=params)
+    operations = pd.read_sql_query("SELECT * FROM operations WHERE medicine_id = ANY(%s) ORDER BY medicine_id, id", conn, params=params)
+    operations_by_medicine = dict(tuple(operations.groupby('medicine_id')))
+    batch = {}
+    for med_id, medicine in medicines.groupby('id'):
+        medicine_ops = operations_by_medicine.get(med_id, operations.iloc[0:0])
+        batch[med_id] = {
+            "medicines": medicine,
+            "companies": companies[companies['id'] == medicine['owned_by'].iloc[0]],
+            "locations": locations[locations['id'].isin(medicine_ops['location_id'])],
+            "operations": medicine_ops,
+        }
+    empty = {"medicines": medicines.iloc[0:0], "companies": companies.iloc[0:0], "locations": locations.iloc[0:0], "operations": operations.iloc[0:0]}
+    return batch, empty
+
+def load_medicine_report_data(conn, med_id):
+    batch, empty = load_report_batch_data(conn, [med_id])
+    return batch.get(med_id, empty)
+
+def fill_report_table(doc, headers, rows, style):
+    # Строки данных копируются из шаблонной строки на уровне XML. Обращения table.rows[i] и column.cells
+    # в python-docx каждый раз обходят всю таблицу, поэтому заполнение по ячейкам было квадратичным.
+    table = doc.add_table(rows=1, cols=len(headers))
+    table.style = 'Table Grid'
+    table.autofit = True
+    for cell, header in zip(table.rows[0].cells, headers):
+        cell.paragraphs[0].style = style
+        cell.paragraphs[0].add_run(header)
+    template = table.add_row()._tr
+    for cell in table.rows[1].cells:
+        cell.paragraphs[0].style = style
+        cell.paragraphs[0].add_run()._r.add_t("").set(qn('xml:space'), 'preserve')
+    tbl = table._tbl
+    tbl.remove(template)
+    text_tag = qn('w:t')
+    for values in rows:
+        tr = copy.deepcopy(template)
+        for text, value in zip(tr.iter(text_tag), values):
+            text.text = value
+        tbl.append(tr)
+    return table
+
+def report_field_rows(row, fields):
+    return [(title, str(row.get(column, 'Не указано'))) for title, column in fields]
+
+REPORT_MEDICINE_FIELDS = [("Название", 'name'), ("GTIN", 'gtin'), ("SKU", 'sku'), ("Рынок", 'market'), ("Партия", 'batch_number'),
+                          ("Срок годности", 'expiration_date'), ("Форма", 'dosage_form'), ("Ингредиент", 'active_ingredient'),
+                          ("Упаковка", 'package_size'), ("Код АТС", 'atc_code')]
+REPORT_COMPANY_FIELDS = [("GLN", 'gln'), ("Краткое название", 'name_short'), ("Полное название", 'name_full'),
+                         ("Страна", 'registration_country'), ("Адрес", 'address'), ("Тип", 'type')]
+REPORT_LOCATION_COLUMNS = {"gln": "GLN", "country": "Страна", "address": "Адрес", "role": "Роль", "name_short": "Краткое название", "name_full": "Полное название"}
+
+def render_medicine_report(report_title, data):
+    filtered_meds = data["medicines"]
+    filtered_companies = data["companies"]
+    filtered_locations = data["locations"]
+    filtered_ops = data["operations"]
+
+    # Создание отчета
+    doc = Document()
+    # Настройка стилей для компактности
+    styles = doc.styles
+    compact_style = styles.add_style('Compact', WD_STYLE_TYPE.PARAGRAPH)
+    compact_style.font.size = Pt(9)  # Меньший шрифт
+    compact_style.paragraph_format.space_after = Pt(2)  # Минимальный отступ после абзаца
+    compact_style.paragraph_format.line_spacing = 1.0  # Одинарный межстрочный интервал
+
+    doc.add_heading("KVINTA (отчеты)", 0)
+    doc.add_heading(f"Отчет: {report_title}", 1)
+
+    # Препарат
+    doc.add_heading("Препарат", level=2)
+    if not filtered_meds.empty:
+        fill_report_table(doc, ["Параметр", "Значение"], report_field_rows(filtered_meds.iloc[0], REPORT_MEDICINE_FIELDS), compact_style)
+    else:
+        doc.add_paragraph("Данные о препарате не найдены", style='Compact')
+
+    # Компания
+    doc.add_heading("Компания", level=2)
+    if not filtered_companies.empty:
+        row = filtered_companies.iloc[0]
+        fields = report_field_rows(row, REPORT_COMPANY_FIELDS)
+        fields.insert(3, ("GCP", "Да" if row.get('gcp_compliant', False) else "Нет"))
+        fill_report_table(doc, ["Параметр", "Значение"], fields, compact_style)
+    else:
+        doc.add_paragraph("Компания не найдена", style='Compact')
+
+    # Местоположение
+    doc.add_heading("Местоположение", level=2)
+    if not filtered_locations.empty:
+        columns = [filtered_locations[column].map(str) for column in REPORT_LOCATION_COLUMNS]
+        fill_report_table(doc, list(REPORT_LOCATION_COLUMNS.values()), zip(*columns), compact_style)
+    else:
+        doc.add_paragraph("Локации не найдены", style='Compact')
+
+    # Операции: названия подставляются через словари id -> название, а не поиском по таблице для каждой строки
+    doc.add_heading("Операции", level=2)
+    if not filtered_ops.empty:
+        medicine_names = dict(zip(filtered_meds['id'], filtered_meds['name']))
+        location_names = dict(zip(filtered_locations['id'], filtered_locations['name_short'])) if not filtered_locations.empty else {}
+        rows = zip(
+            filtered_ops['medicine_id'].map(medicine_names).fillna('Не указан').map(str),
+            filtered_ops['location_id'].map(location_names).fillna('Не указана').map(str),
+            filtered_ops['operation_type'].map(str),
+            filtered_ops['operation_date'].map(str),
+            filtered_ops['quantity'].map(str),
+        )
+        fill_report_table(doc, ["Препарат", "Локация", "Тип операции", "Дата", "Кол-во"], rows, compact_style)
+    else:
+        doc.add_paragraph("Операции не найдены", style='Compact')
+    # Сохранение в Word
+    word_buffer = io.BytesIO()
+    doc.save(word_buffer)
+    return word_buffer.getvalue()
+
+def build_medicine_report(report_title, med_id):
+    with get_db_pool().connection() as conn:
+        data = load_medicine_report_data(conn, med_id)
+    return render_medicine_report(report_title, data)
+
+# Пакетные отчёты: родительский процесс читает данные, документы собираются параллельно в пуле процессов.
+# Пул запускается методом spawn, а функция сборки берётся из модуля, импортированного по имени: сценарий
+# Streamlit выполняется как __main__, и ссылки на его функции не восстанавливаются в дочерних процессах.
+REPORT_PROCESSES = max(1, int(os.environ.get("PHARMA_REPORT_PROCESSES", os.cpu_count() or 2)))
+REPORT_BATCH_CHUNK_SIZE = REPORT_PROCESSES * 4  # Сколько препаратов загружается в память за один раз
+
+@st.cache_resource
+def get_report_process_pool():
+    return ProcessPoolExecutor(max_workers=REPORT_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+def select_report_medicines(medicine_ids=None, company_id=None, atc_prefix=None):
+    conditions, params = [], []
+    if medicine_ids:
+        conditions.append("id = ANY(%s)")
+        params.append([int(med_id) for med_id in medicine_ids])
+    if company_id is not None:
+        conditions.append("owned_by = %s")
+        params.append(int(company_id))
+    if atc_prefix:
+        conditions.append("atc_code LIKE %s")
+        params.append(f"{escape_like(atc_prefix.strip().upper())}%")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with get_db_pool().connection() as conn:
+        return [row[0] for row in conn.execute(f"SELECT id FROM medicines {where} ORDER BY id", params).fetchall()]
+
+def report_file_name(title, data, med_id):
+    name = data["medicines"]['name'].iloc[0] if not data["medicines"].empty else "medicine"
+    return re.sub(r'[^0-9A-Za-zА-Яа-я._-]', '_', f"{title}_{name}_{med_id}") + ".docx"
+
+def build_report_batch(title, med_ids, output, progress=None):
+    render = importlib.import_module("pharma_meta_system").render_medicine_report
+    pool = get_report_process_pool()
+    done = 0
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for start in range(0, len(med_ids), REPORT_BATCH_CHUNK_SIZE):
+            chunk = med_ids[start:start + REPORT_BATCH_CHUNK_SIZE]
+            with get_db_pool().connection() as conn:
+                batch, empty = load_report_batch_data(conn, chunk)
+            pending, restarted = list(chunk), False
+            while pending:
+                try:
+                    futures = {pool.submit(render, title, batch.get(med_id, empty)): med_id for med_id in pending}
+                    for future in as_completed(futures):
+                        med_id = futures[future]
+                        archive.writestr(report_file_name(title, batch.get(med_id, empty), med_id), future.result())
+                        pending.remove(med_id)
+                        restarted = False
+                        done += 1
+                        if progress:
+                            progress(done / len(med_ids), f"Сформировано отчетов: {done} из {len(med_ids)}")
+                except BrokenProcessPool:
+                    # Процесс пула аварийно завершился: сломанный пул убирается из кэша, оставшиеся отчёты строятся в новом.
+                    # Если и новый пул ломается, не построив ни одного отчёта, ошибка уходит в задачу
+                    if restarted:
+                        raise
+                    restarted = True
+                    log_action("Report process pool broken", f"Title: {title}, pending reports: {len(pending)}")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    get_report_process_pool.clear()
+                    pool = get_report_process_pool()
+    return done
+
+def show_report_batch_form(medicine_options):
+    companies = read_query(("companies",), "SELECT id, name_full FROM companies ORDER BY name_full, id")
+    company_options = {"Все компании": None, **{f"{row['name_full']} (ID: {row['id']})": row['id'] for _, row in companies.iterrows()}}
+    with st.form(key="report_batch_form"):
+        report_title = st.text_input("Название отчета", placeholder="Введите название отчета")
+        selected = st.multiselect("Препараты", [key for key, value in medicine_options.items() if value is not None],
+                                  help="Если не выбраны, отчеты строятся по всем препаратам, подходящим под фильтры")
+        company_choice = st.selectbox("Компания-владелец", list(company_options.keys()))
+        atc_prefix = st.text_input("Код АТС начинается с", placeholder="Например, A10")
+        submit_button = st.form_submit_button("Сформировать пакет")
+    if not submit_button:
+        return
+    if not report_title:
+        st.error("Название отчета обязательно")
+        return
+    company_id = company_options[company_choice]
+    params = {"title": report_title, "medicine_ids": [int(medicine_options[key]) for key in selected],
+              "company_id": int(company_id) if company_id is not None else None, "atc_prefix": atc_prefix.strip() or None}
+    job_id = submit_job("report_batch", params, st.session_state['username'])
+    if job_id:
+        st.success(f"Пакет отчетов поставлен в очередь: задача #{job_id}. Архив будет доступен на странице 'Задачи'.")
 
 def show_reports():
     if st.session_state['role'] not in ['admin', 'analyst']:
@@ -1318,15 +3244,15 @@ def show_reports():
         return
     st.subheader("Создание отчетов")
 
-    medicines = get_medications()
-    companies = get_companies()
-    locations = get_locations()
-    operations = get_operations()
-
+    medicines = read_query(("medicines",), "SELECT id, name FROM medicines ORDER BY id")
     medicine_options = {f"{row['name']} (ID: {row['id']})": row['id'] for _, row in medicines.iterrows()} if not medicines.empty else {"Нет препаратов": None}
+    if st.radio("Режим", ["Один препарат", "Пакет отчетов"], horizontal=True) == "Пакет отчетов":
+        show_report_batch_form(medicine_options)
+        return
     with st.form(key="report_form"):
         report_title = st.text_input("Название отчета", placeholder="Введите название отчета")
         medicine_choice = st.selectbox("Препарат", list(medicine_options.keys()), help="Выберите препарат для отчета")
+        in_background = st.checkbox("Сформировать в фоне", help="Отчет будет доступен на странице 'Задачи'")
         submit_button = st.form_submit_button("Сформировать отчет")
 
     if submit_button:
@@ -1337,149 +3263,289 @@ def show_reports():
             st.error("Выберите препарат")
             return
 
-        # Фильтрация данных
-        med_id = medicine_options[medicine_choice]
-        filtered_meds = medicines[medicines['id'] == med_id]
-        filtered_ops = operations[operations['medicine_id'] == med_id]
-        company_id = filtered_meds['owned_by'].iloc[0] if not filtered_meds.empty else None
-        filtered_companies = companies[companies['id'] == company_id] if company_id else pd.DataFrame()
-        location_ids = filtered_ops['location_id'].unique() if not filtered_ops.empty else []
-        filtered_locations = locations[locations['id'].isin(location_ids)] if location_ids else pd.DataFrame()
-
-        # Создание отчета
-        doc = Document()
-        # Настройка стилей для компактности
-        styles = doc.styles
-        compact_style = styles.add_style('Compact', WD_STYLE_TYPE.PARAGRAPH)
-        compact_style.font.size = Pt(9)  # Меньший шрифт
-        compact_style.paragraph_format.space_after = Pt(2)  # Минимальный отступ после абзаца
-        compact_style.paragraph_format.line_spacing = 1.0  # Одинарный межстрочный интервал
-
-        doc.add_heading("KVINTA (отчеты)", 0)
-        doc.add_heading(f"Отчет: {report_title}", 1)
-
-        # Препарат
-        doc.add_heading("Препарат", level=2)
-        if not filtered_meds.empty:
-            row = filtered_meds.iloc[0]
-            fields = [
-                ("Название", str(row.get('name', 'Не указано'))),
-                ("GTIN", str(row.get('gtin', 'Не указано'))),
-                ("SKU", str(row.get('sku', 'Не указано'))),
-                ("Рынок", str(row.get('market', 'Не указано'))),
-                ("Партия", str(row.get('batch_number', 'Не указано'))),
-                ("Срок годности", str(row.get('expiration_date', 'Не указано'))),
-                ("Форма", str(row.get('dosage_form', 'Не указано'))),
-                ("Ингредиент", str(row.get('active_ingredient', 'Не указано'))),
-                ("Упаковка", str(row.get('package_size', 'Не указано'))),
-                ("Код АТС", str(row.get('atc_code', 'Не указано')))
-            ]
-            table = doc.add_table(rows=len(fields) + 1, cols=2)
-            table.style = 'Table Grid'
-            table.autofit = True
-            for col in table.columns:
-                for cell in col.cells:
-                    cell.paragraphs[0].style = compact_style
-            # Заголовки
-            headers = ["Параметр", "Значение"]
-            table.rows[0].cells[0].text = headers[0]
-            table.rows[0].cells[1].text = headers[1]
-            # Данные
-            for i, (header, value) in enumerate(fields, 1):
-                cells = table.rows[i].cells
-                cells[0].text = header
-                cells[1].text = value
-        else:
-            p = doc.add_paragraph("Данные о препарате не найдены", style='Compact')
-
-        # Компания
-        doc.add_heading("Компания", level=2)
-        if not filtered_companies.empty:
-            row = filtered_companies.iloc[0]
-            fields = [
-                ("GLN", str(row.get('gln', 'Не указано'))),
-                ("Краткое название", str(row.get('name_short', 'Не указано'))),
-                ("Полное название", str(row.get('name_full', 'Не указано'))),
-                ("GCP", "Да" if row.get('gcp_compliant', False) else "Нет"),
-                ("Страна", str(row.get('registration_country', 'Не указано'))),
-                ("Адрес", str(row.get('address', 'Не указано'))),
-                ("Тип", str(row.get('type', 'Не указано')))
-            ]
-            table = doc.add_table(rows=len(fields) + 1, cols=2)
-            table.style = 'Table Grid'
-            table.autofit = True
-            for col in table.columns:
-                for cell in col.cells:
-                    cell.paragraphs[0].style = compact_style
-            headers = ["Параметр", "Значение"]
-            table.rows[0].cells[0].text = headers[0]
-            table.rows[0].cells[1].text = headers[1]
-            for i, (header, value) in enumerate(fields, 1):
-                cells = table.rows[i].cells
-                cells[0].text = header
-                cells[1].text = value
-        else:
-            p = doc.add_paragraph("Компания не найдена", style='Compact')
-
-        # Местоположение
-        doc.add_heading("Местоположение", level=2)
-        if not filtered_locations.empty:
-            table = doc.add_table(rows=len(filtered_locations) + 1, cols=6)
-            table.style = 'Table Grid'
-            table.autofit = True
-            for col in table.columns:
-                for cell in col.cells:
-                    cell.paragraphs[0].style = compact_style
-            headers = ["GLN", "Страна", "Адрес", "Роль", "Краткое название", "Полное название"]
-            for i, header in enumerate(headers):
-                table.rows[0].cells[i].text = header
-            for idx, row in enumerate(filtered_locations.itertuples(), 1):
-                cells = table.rows[idx].cells
-                cells[0].text = str(row.gln)
-                cells[1].text = str(row.country)
-                cells[2].text = str(row.address)
-                cells[3].text = str(row.role)
-                cells[4].text = str(row.name_short)
-                cells[5].text = str(row.name_full)
-        else:
-            p = doc.add_paragraph("Локации не найдены", style='Compact')
-
-        # Операции
-        doc.add_heading("Операции", level=2)
-        if not filtered_ops.empty:
-            table = doc.add_table(rows=len(filtered_ops) + 1, cols=5)
-            table.style = 'Table Grid'
-            table.autofit = True
-            for col in table.columns:
-                for cell in col.cells:
-                    cell.paragraphs[0].style = compact_style
-            headers = ["Препарат", "Локация", "Тип операции", "Дата", "Кол-во"]
-            for i, header in enumerate(headers):
-                table.rows[0].cells[i].text = header
-            for idx, row in enumerate(filtered_ops.itertuples(), 1):
-                med_name = medicines[medicines['id'] == row.medicine_id]['name'].iloc[0] if row.medicine_id in medicines['id'].values else 'Не указан'
-                loc_name = locations[locations['id'] == row.location_id]['name_short'].iloc[0] if row.location_id in locations['id'].values else 'Не указана'
-                cells = table.rows[idx].cells
-                cells[0].text = med_name
-                cells[1].text = loc_name
-                cells[2].text = str(row.operation_type)
-                cells[3].text = str(row.operation_date)
-                cells[4].text = str(row.quantity)
-        else:
-            p = doc.add_paragraph("Операции не найдены", style='Compact')
-        # Сохранение в Word
-        word_buffer = io.BytesIO()
-        doc.save(word_buffer)
-        word_buffer.seek(0)
+        med_id = int(medicine_options[medicine_choice])
+        if in_background:
+            job_id = submit_job("report", {"title": report_title, "medicine_id": med_id}, st.session_state['username'])
+            if job_id:
+                st.success(f"Отчет поставлен в очередь: задача #{job_id}. Скачать его можно на странице 'Задачи'.")
+            return
+        try:
+            report = build_medicine_report(report_title, med_id)
+        except psycopg.Error as e:
+            st.error(f"Ошибка формирования отчета: {e}")
+            return
 
         st.download_button(
             label="Скачать отчет (Word)",
-            data=word_buffer,
+            data=report,
             file_name=f"{report_title}.docx",
             mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         )
         log_action("Generated report", f"Title: {report_title}", st.session_state['username'])
        
+# Проверка качества данных: контрольные цифры GTIN/GLN во всех таблицах
+GS1_SCAN_FETCH_SIZE = 200000
+
+def scan_gs1_identifiers():
+    conn = get_db_connection()
+    if conn is None:
+        return pd.DataFrame(columns=["table", "id", "column", "value"])
+    invalid = []
+    try:
+        for table, columns in GS1_COLUMNS.items():
+            for column, lengths in columns.items():
+                # Серверный курсор: таблица читается порциями, а не целиком
+                with conn.cursor(name=f"gs1_scan_{table}_{column}") as c:
+                    c.execute(f"SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL AND {column} <> ''")
+                    while True:
+                        rows = c.fetchmany(GS1_SCAN_FETCH_SIZE)
+                        if not rows:
+                            break
+                        ids, codes = zip(*rows)
+                        bad = np.flatnonzero(~gs1_check_digits_valid(codes, lengths))
+                        if len(bad):
+                            invalid.append(pd.DataFrame({"table": table, "id": np.asarray(ids)[bad], "column": column,
+                                                         "value": np.asarray(codes, dtype=object)[bad]}))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    if not invalid:
+        return pd.DataFrame(columns=["table", "id", "column", "value"])
+    return pd.concat(invalid, ignore_index=True)
+
+def show_data_quality():
+    if st.session_state['role'] not in ['admin', 'analyst']:
+        st.error("Доступ запрещен")
+        return
+    st.subheader("Качество данных")
+    st.write("Проверка длины и контрольной цифры GTIN препаратов и GLN компаний и локаций.")
+    if st.button("Проверить GTIN/GLN"):
+        invalid = scan_gs1_identifiers()
+        log_action("GS1 data quality scan", f"Invalid identifiers: {len(invalid)}", st.session_state['username'])
+        if invalid.empty:
+            st.success("Ошибок в GTIN/GLN не найдено")
+        else:
+            st.warning(f"Найдено некорректных идентификаторов: {len(invalid)}")
+            st.dataframe(invalid.rename(columns={"table": "Таблица", "id": "ID", "column": "Поле", "value": "Значение"}), hide_index=True)
+            st.download_button("Скачать отчет (CSV)", data=invalid.to_csv(index=False), file_name="gs1_invalid_identifiers.csv", mime="text/csv")
+
+# Остатки: текущие читаются из stock_balances, на дату — из ближайшего снимка плюс дневные итоги после него.
+# Операции без даты учитываются только в текущих остатках.
+STOCK_AS_OF_QUERY = f'''WITH base AS (
+        SELECT max(snapshot_date) AS snapshot_date FROM stock_snapshots WHERE snapshot_date <= %(day)s
+    ), movements AS (
+        SELECT medicine_id, location_id, quantity FROM stock_snapshots
+        WHERE snapshot_date = (SELECT snapshot_date FROM base)
+        UNION ALL
+        SELECT r.medicine_id, r.location_id, s.sign * r.quantity_total
+        FROM {OPERATIONS_ROLLUP_TABLE} r JOIN stock_operation_signs s ON s.operation_type = r.operation_type
+        WHERE r.day <= %(day)s AND r.day > COALESCE((SELECT snapshot_date FROM base), '-infinity'::date)
+    )
+    SELECT medicine_id, location_id, sum(quantity) AS quantity FROM movements GROUP BY 1, 2'''
+
+def stock_query(source, medicine_id=None, location_id=None):
+    conditions = []
+    if medicine_id is not None:
+        conditions.append("b.medicine_id = %(medicine_id)s")
+    if location_id is not None:
+        conditions.append("b.location_id = %(location_id)s")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f'''SELECT b.medicine_id, m.name AS medicine_name, m.batch_number, b.location_id, l.name_short AS location_name, b.quantity
+               FROM ({source}) b
+               LEFT JOIN medicines m ON m.id = b.medicine_id
+               LEFT JOIN locations l ON l.id = b.location_id
+               {where}
+               ORDER BY m.name, l.name_short'''
+
+def get_stock_balances(medicine_id=None, location_id=None):
+    query = stock_query("SELECT medicine_id, location_id, quantity FROM stock_balances", medicine_id, location_id)
+    return read_query(("operations", "medicines", "locations"), query, {"medicine_id": medicine_id, "location_id": location_id})
+
+def get_stock_as_of(day, medicine_id=None, location_id=None):
+    query = stock_query(STOCK_AS_OF_QUERY, medicine_id, location_id)
+    return read_query(("operations", "medicines", "locations"), query, {"day": day, "medicine_id": medicine_id, "location_id": location_id})
+
+def take_stock_snapshot(c, day):
+    c.execute("DELETE FROM stock_snapshots WHERE snapshot_date = %(day)s", {"day": day})
+    c.execute(f"INSERT INTO stock_snapshots (snapshot_date, medicine_id, location_id, quantity) SELECT %(day)s, * FROM ({STOCK_AS_OF_QUERY}) s",
+              {"day": day})
+    return c.rowcount
+
+STOCK_SNAPSHOT_LOCK_ID = 7305003  # Снимок делает одна реплика, остальные пропускают запуск
+
+def run_stock_snapshot_job():
+    # Снимок на конец вчерашнего дня; повторяется, если снимок удалили операции задним числом
+    day = date.today() - timedelta(days=1)
+    with get_db_pool().connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT pg_try_advisory_xact_lock(%s)", (STOCK_SNAPSHOT_LOCK_ID,))
+        if not c.fetchone()[0]:
+            return None
+        c.execute("SELECT EXISTS (SELECT 1 FROM stock_snapshots WHERE snapshot_date = %s)", (day,))
+        if c.fetchone()[0]:
+            return None
+        rows = take_stock_snapshot(c, day)
+    log_action("Stock snapshot", f"Date: {day}, rows: {rows}")
+    return rows
+
+def _stock_snapshot_loop():
+    while True:
+        try:
+            run_stock_snapshot_job()
+        except Exception:
+            logging.exception("Stock snapshot job failed")
+        time.sleep(EXPIRY_ALERT_CHECK_SECONDS)
+
+@st.cache_resource
+def start_stock_snapshot_job():
+    # Раз в час проверяет, есть ли снимок за вчера, и делает его при необходимости
+    job = threading.Thread(target=_stock_snapshot_loop, name="pharma-stock-snapshots", daemon=True)
+    job.start()
+    return job
+
+# Прослеживаемость: операции препаратов с заданной серией или GTIN в хронологическом порядке.
+# Перемещение — это пара соседних операций одного препарата в разных локациях (LAG по дате).
+TRACE_KEYS = {"Серия": "batch_number", "GTIN": "gtin"}
+TRACE_DEPENDENCIES = ("operations", "medicines", "locations")
+
+def trace_events_query(key):
+    return f'''SELECT o.id, o.medicine_id, m.name AS medicine_name, m.batch_number, m.gtin, o.operation_date, o.operation_type,
+                      LAG(o.location_id) OVER w AS from_location_id, o.location_id, l.name_short AS location_name, o.quantity
+               FROM medicines m
+               JOIN operations o ON o.medicine_id = m.id
+               LEFT JOIN locations l ON l.id = o.location_id
+               WHERE m.{TRACE_KEYS[key]} = %(value)s
+               WINDOW w AS (PARTITION BY o.medicine_id ORDER BY o.operation_date, o.id)'''
+
+def get_trace_medicines(key, value):
+    return read_query(("medicines", "companies"), f"SELECT * FROM medicines_display WHERE {TRACE_KEYS[key]} = %(value)s ORDER BY id", {"value": value})
+
+def get_trace_events(key, value):
+    return read_query(TRACE_DEPENDENCIES, f"{trace_events_query(key)} ORDER BY o.medicine_id, o.operation_date, o.id", {"value": value})
+
+def trace_movements_query(key):
+    # Рёбра графа: откуда -> куда, сколько раз и какое количество; первая операция препарата — вход в цепочку
+    return f'''SELECT e.from_location_id, f.name_short AS from_location_name, e.location_id AS to_location_id,
+                      e.location_name AS to_location_name, count(*) AS movements, sum(e.quantity) AS quantity,
+                      min(e.operation_date) AS first_date, max(e.operation_date) AS last_date
+               FROM ({trace_events_query(key)}) e
+               LEFT JOIN locations f ON f.id = e.from_location_id
+               WHERE e.from_location_id IS DISTINCT FROM e.location_id
+               GROUP BY 1, 2, 3, 4
+               ORDER BY first_date'''
+
+def get_trace_movements(key, value):
+    return read_query(TRACE_DEPENDENCIES, trace_movements_query(key), {"value": value})
+
+def trace_locations_query(key):
+    return f'''WITH traced AS (SELECT id FROM medicines WHERE {TRACE_KEYS[key]} = %(value)s)
+               SELECT o.location_id, l.name_short AS location_name, l.address, count(*) AS operations,
+                      COALESCE(sum(o.quantity) FILTER (WHERE s.sign > 0), 0) AS received,
+                      COALESCE(sum(o.quantity) FILTER (WHERE s.sign < 0), 0) AS written_off,
+                      (SELECT COALESCE(sum(b.quantity), 0) FROM stock_balances b
+                       WHERE b.location_id = COALESCE(o.location_id, 0) AND b.medicine_id IN (SELECT id FROM traced)) AS on_hand,
+                      min(o.operation_date) AS first_seen, max(o.operation_date) AS last_seen
+               FROM operations o
+               JOIN traced t ON t.id = o.medicine_id
+               LEFT JOIN stock_operation_signs s ON s.operation_type = o.operation_type
+               LEFT JOIN locations l ON l.id = o.location_id
+               GROUP BY o.location_id, l.name_short, l.address
+               ORDER BY first_seen'''
+
+def get_trace_locations(key, value):
+    return read_query(TRACE_DEPENDENCIES, trace_locations_query(key), {"value": value})
+
+TRACE_COLUMN_TITLES = {"id": "ID операции", "medicine_id": "ID препарата", "medicine_name": "Препарат", "batch_number": "Серия",
+                       "gtin": "GTIN", "operation_date": "Дата операции", "operation_type": "Тип операции",
+                       "from_location_id": "Из локации (ID)", "from_location_name": "Из локации", "location_id": "ID локации",
+                       "location_name": "Локация", "to_location_id": "В локацию (ID)", "to_location_name": "В локацию",
+                       "quantity": "Количество", "movements": "Перемещений", "first_date": "Первая дата", "last_date": "Последняя дата",
+                       "address": "Адрес", "operations": "Операций", "received": "Поступило", "written_off": "Списано",
+                       "on_hand": "Остаток", "first_seen": "Впервые", "last_seen": "Последний раз"}
+
+def titled_trace_query(conn, query, params):
+    # Столбцы выгрузки подписываются по-русски прямо в запросе, чтобы заголовки одинаково попадали в CSV и Excel
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT * FROM ({query}) t LIMIT 0", params)
+        columns = [column.name for column in cursor.description]
+    return "SELECT " + ", ".join(f'{column} AS "{TRACE_COLUMN_TITLES.get(column, column)}"' for column in columns) + f" FROM ({query}) t"
+
+def write_trace_export(conn, key, value, fmt, path):
+    # Файл пишется потоково с диска базы: цепочка любой длины, в Excel — с переносом на новые листы
+    params = {"value": value}
+    events = titled_trace_query(conn, f"{trace_events_query(key)} ORDER BY o.medicine_id, o.operation_date, o.id", params)
+    if fmt == "csv":
+        return write_csv_export(conn, events, path, params)
+    return write_xlsx_sheets(conn, [("Локации", titled_trace_query(conn, trace_locations_query(key), params), params),
+                                    ("Перемещения", titled_trace_query(conn, trace_movements_query(key), params), params),
+                                    ("Операции", events, params)], path)
+
+def show_traceability():
+    if st.session_state['role'] not in ['admin', 'analyst']:
+        st.error("Доступ запрещен")
+        return
+    st.subheader("Прослеживаемость")
+    key = st.radio("Искать по", list(TRACE_KEYS.keys()), horizontal=True)
+    value = st.text_input(f"{key} препарата").strip()
+    if not value:
+        st.info("Введите значение для построения цепочки перемещений.")
+        return
+    medicines = get_trace_medicines(key, value)
+    if medicines.empty:
+        st.warning("Препараты с таким значением не найдены.")
+        return
+    st.write(f"Препаратов: {len(medicines)}")
+    st.dataframe(medicines, hide_index=True)
+    locations = get_trace_locations(key, value)
+    movements = get_trace_movements(key, value)
+    events = get_trace_events(key, value)
+    if events.empty:
+        st.info("Операций с этими препаратами нет.")
+        return
+    st.write("Локации")
+    st.dataframe(locations.rename(columns=TRACE_COLUMN_TITLES), hide_index=True)
+    st.write("Перемещения между локациями")
+    st.dataframe(movements.rename(columns=TRACE_COLUMN_TITLES), hide_index=True)
+    st.write(f"Операции: {len(events)}")
+    st.dataframe(events.head(VIEW_PAGE_SIZE).rename(columns=TRACE_COLUMN_TITLES), hide_index=True)
+    # Файлы строятся только по запросу пользователя, фоновой задачей: перезапуски страницы их не пересобирают
+    for label, fmt in (("Выгрузить операции (CSV)", "csv"), ("Выгрузить отчет (Excel)", "xlsx")):
+        if st.button(label):
+            job_id = submit_job("trace", {"key": key, "value": value, "format": fmt}, st.session_state['username'])
+            if job_id is not None:
+                st.success(f"Задача #{job_id} поставлена в очередь. Файл будет доступен на странице 'Задачи'.")
+    log_action("Traceability query", f"{key}: {value}, operations: {len(events)}", st.session_state['username'])
+
+STOCK_COLUMN_TITLES = {"medicine_id": "ID препарата", "medicine_name": "Препарат", "batch_number": "Серия",
+                       "location_id": "ID локации", "location_name": "Локация", "quantity": "Остаток"}
+
+def show_stock():
+    if st.session_state['role'] not in ['admin', 'analyst']:
+        st.error("Доступ запрещен")
+        return
+    st.subheader("Остатки")
+    mode = st.radio("Показать", ["Текущие остатки", "Остатки на дату"], horizontal=True)
+    medicines = read_query(("medicines",), "SELECT id, name FROM medicines ORDER BY name, id")
+    locations = read_query(("locations",), "SELECT id, name_short FROM locations ORDER BY name_short, id")
+    medicine_options = {"Все препараты": None, **{f"{row['name']} (ID: {row['id']})": row['id'] for _, row in medicines.iterrows()}}
+    location_options = {"Все локации": None, **{f"{row['name_short']} (ID: {row['id']})": row['id'] for _, row in locations.iterrows()}}
+    medicine_id = medicine_options[st.selectbox("Препарат", list(medicine_options.keys()))]
+    location_id = location_options[st.selectbox("Локация", list(location_options.keys()))]
+    medicine_id = int(medicine_id) if medicine_id is not None else None
+    location_id = int(location_id) if location_id is not None else None
+    if mode == "Остатки на дату":
+        as_of = st.date_input("Дата", value=date.today())
+        balances = get_stock_as_of(as_of, medicine_id, location_id)
+    else:
+        balances = get_stock_balances(medicine_id, location_id)
+    if st.checkbox("Скрыть нулевые остатки", value=True) and not balances.empty:
+        balances = balances[balances['quantity'] != 0]
+    if balances.empty:
+        st.info("Остатков по выбранным условиям нет.")
+        return
+    st.write(f"Итого: {int(balances['quantity'].sum())}")
+    st.dataframe(balances.rename(columns=STOCK_COLUMN_TITLES), hide_index=True)
+
 def show_logs():
     st.subheader("Просмотр логов (Админ)")
     if st.session_state['role'] != 'admin':
@@ -1621,7 +3687,13 @@ def show_home():
         st.rerun()
 
 def main():
-    init_db()
+    if not ensure_schema():
+        ensure_schema.clear()  # Повторить попытку при следующем запуске скрипта
+    start_change_listener()
+    start_expiry_alert_job()
+    start_stock_snapshot_job()
+    start_operation_partitions_job()
+    get_job_executor()
     clear_logs_daily()
 
     st.markdown("""
@@ -1675,11 +3747,11 @@ def main():
     elif st.session_state['show_main_page']:
         if st.session_state['role'] in ['admin', 'operator', 'analyst']:
             if st.session_state['role'] == 'admin':
-                menu = ["Главная страница", "Просмотр", "Добавить", "Редактировать", "Фильтрация", "Визуализация", "Отчеты", "Логи"]
+                menu = ["Главная страница", "Просмотр", "Добавить", "Редактировать", "Фильтрация", "Визуализация", "Отчеты", "Остатки", "Прослеживаемость", "Качество данных", "Задачи", "Резервные копии", "Логи"]
             elif st.session_state['role'] == 'analyst':
-                menu = ["Главная страница", "Просмотр", "Добавить", "Редактировать", "Фильтрация", "Визуализация", "Отчеты"]
+                menu = ["Главная страница", "Просмотр", "Добавить", "Редактировать", "Фильтрация", "Визуализация", "Отчеты", "Остатки", "Прослеживаемость", "Качество данных", "Задачи"]
             else:  # operator
-                menu = ["Главная страница", "Просмотр", "Добавить"]
+                menu = ["Главная страница", "Просмотр", "Добавить", "Задачи"]
 
             st.sidebar.title(f"Добро пожаловать, {st.session_state['role']}")
             choice = st.sidebar.selectbox("Меню", menu, index=0)
@@ -1698,6 +3770,16 @@ def main():
                 show_visualize()
             elif choice == "Отчеты":
                 show_reports()
+            elif choice == "Остатки":
+                show_stock()
+            elif choice == "Прослеживаемость":
+                show_traceability()
+            elif choice == "Качество данных":
+                show_data_quality()
+            elif choice == "Задачи":
+                show_jobs()
+            elif choice == "Резервные копии":
+                show_backups()
             elif choice == "Логи":
                 show_logs()
         else:
@@ -1707,5 +3789,150 @@ def main():
         show_kvinta_page()
             
             
+# Команды для запуска по расписанию: python pharma_meta_system.py <команда> [аргументы]
+def cli_scan_gs1(args):
+    output = args[0] if args else "gs1_invalid_identifiers.csv"
+    invalid = scan_gs1_identifiers()
+    invalid.to_csv(output, index=False)
+    log_action("GS1 data quality scan", f"Invalid identifiers: {len(invalid)}, report: {output}")
+    print(f"Invalid identifiers: {len(invalid)}, report: {output}")
+
+def cli_rebuild_rollups(args):
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit(1)
+    try:
+        rebuild_operation_rollups(conn.cursor())
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    log_action("Rebuilt operation rollups")
+    print("Operation rollups rebuilt")
+
+def cli_rebuild_stock(args):
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit(1)
+    try:
+        rebuild_stock_balances(conn.cursor())
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    log_action("Rebuilt stock balances")
+    print("Stock balances rebuilt")
+
+def cli_stock_snapshot(args):
+    # По умолчанию снимок за вчера: день уже закончился
+    day = datetime.strptime(args[0], "%Y-%m-%d").date() if args else date.today() - timedelta(days=1)
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit(1)
+    try:
+        rows = take_stock_snapshot(conn.cursor(), day)
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    log_action("Stock snapshot", f"Date: {day}, rows: {rows}")
+    print(f"Stock snapshot for {day}: {rows} rows")
+
+def cli_expiry_alerts(args):
+    rows = run_expiry_alert_job(force=True)
+    if rows is None:
+        print("Expiry alerts were not generated: database unavailable or another job is running")
+        sys.exit(1)
+    print(f"Expiry alerts: {rows} rows")
+
+def cli_export(args):
+    if len(args) < 2 or args[0] not in DISPLAY_VIEWS or args[1] not in EXPORT_MIME_TYPES:
+        print(f"Usage: export {{{'|'.join(DISPLAY_VIEWS)}}} {{{'|'.join(EXPORT_MIME_TYPES)}}} [path]")
+        sys.exit(1)
+    table, fmt = args[0], args[1]
+    path = args[2] if len(args) > 2 else f"{table}_export.{fmt}"
+    with get_db_pool().connection() as conn:
+        rows = write_export(conn, export_query(DISPLAY_VIEWS[table], VIEW_DISPLAY_COLUMNS[table]), fmt, path, sheet_title=table)
+    log_action(f"Exported data from {table}", f"Rows: {rows}, format: {fmt}, file: {path}")
+    print(f"Exported {rows} rows to {path}")
+
+def cli_export_bundle(args):
+    path = args[0] if args else f"pharma_bundle_{datetime.now():%Y%m%d_%H%M%S}.zip"
+    manifest = export_bundle(path)
+    rows = ", ".join(f"{table}: {info['rows']}" for table, info in manifest["tables"].items())
+    log_action("Exported data bundle", f"File: {path}, {rows}")
+    print(f"Bundle written to {path} ({rows})")
+
+def cli_restore_bundle(args):
+    if not args:
+        print("Usage: restore-bundle <path>")
+        sys.exit(1)
+    restored = restore_bundle(args[0])
+    rows = ", ".join(f"{table}: {count}" for table, count in restored.items())
+    log_action("Restored data bundle", f"File: {args[0]}, {rows}")
+    print(f"Bundle restored from {args[0]} ({rows})")
+
+def cli_partition_operations(args):
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit(1)
+    try:
+        moved = partition_operations_table(conn.cursor())
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    log_action("Partitioned operations table", f"Rows moved: {moved}")
+    print(f"Operations table is partitioned by month, rows moved: {moved}")
+
+def cli_create_sort_indexes(args):
+    # CONCURRENTLY не блокирует запись в таблицу, но не работает внутри транзакции
+    if any(table not in VIEW_SORT_COLUMNS for table in args):
+        print(f"Usage: create-sort-indexes [{'|'.join(VIEW_SORT_COLUMNS)} ...]")
+        sys.exit(1)
+    tables = args or [table for table in VIEW_SORT_COLUMNS if table not in VIEW_SORT_INDEX_MIGRATION_TABLES]
+    with psycopg.connect(get_db_conninfo(), autocommit=True) as conn:
+        for table in tables:
+            for statement in view_sort_index_statements(table, concurrently=True):
+                conn.execute(statement)
+    log_action("Created view sort indexes", f"Tables: {', '.join(tables)}")
+    print(f"Sort indexes created for: {', '.join(tables)}")
+
+def cli_ensure_partitions(args):
+    months_ahead = int(args[0]) if args else OPERATIONS_PARTITION_MONTHS_AHEAD
+    created = ensure_operation_partitions(months_ahead)
+    print(f"Operations partitions ensured for {months_ahead} months ahead, created: {', '.join(created) or 'none'}")
+
+def cli_detach_operations_partition(args):
+    if not args:
+        print("Usage: detach-operations-partition YYYY-MM")
+        sys.exit(1)
+    month = datetime.strptime(args[0], "%Y-%m").date()
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit(1)
+    try:
+        name = detach_operations_partition(conn.cursor(), month)
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    invalidate_tables("operations")
+    log_action("Detached operations partition", name)
+    print(f"Detached partition: {name}")
+
+CLI_COMMANDS = {
+    "scan-gs1": cli_scan_gs1,
+    "rebuild-rollups": cli_rebuild_rollups,
+    "rebuild-stock": cli_rebuild_stock,
+    "stock-snapshot": cli_stock_snapshot,
+    "expiry-alerts": cli_expiry_alerts,
+    "export": cli_export,
+    "export-bundle": cli_export_bundle,
+    "restore-bundle": cli_restore_bundle,
+    "partition-operations": cli_partition_operations,
+    "create-sort-indexes": cli_create_sort_indexes,
+    "ensure-partitions": cli_ensure_partitions,
+    "detach-operations-partition": cli_detach_operations_partition,
+}
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        CLI_COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
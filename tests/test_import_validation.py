@@ -0,0 +1,79 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+import pharma_meta_system as pms
+
+
+def read_csv_chunks(text):
+    return [chunk for chunk, _ in pms.iter_import_chunks(io.BytesIO(text.encode()), is_csv=True)]
+
+
+def check_digit_errors(report, column):
+    errors = report[(report["column"] == column) & report["error"].str.contains("контрольную цифру")]
+    return errors["row"].tolist()
+
+
+def test_gs1_check_digits_accept_numeric_codes():
+    # Числовой столбец с пропуском — float64
+    codes = pd.Series([4006381333931, np.nan, 4006381333932])
+    assert codes.dtype.kind == "f"
+    assert pms.gs1_check_digits_valid(codes, pms.GTIN_LENGTHS).tolist() == [True, False, False]
+    assert pms.gs1_check_digits_valid(["4006381333931", None], pms.GTIN_LENGTHS).tolist() == [True, False]
+
+
+def test_csv_with_blank_gtin_keeps_valid_codes():
+    chunks = read_csv_chunks(
+        "name,gtin,quantity\n"
+        "Аспирин,04006381333931,1\n"
+        "Парацетамол,,2\n"
+        "Ибупрофен,4006381333931,3\n"
+    )
+    df = pd.concat(chunks)
+    assert df["gtin"].tolist()[0] == "04006381333931"
+    report = pms.validate_frame("medicines", df)
+    assert check_digit_errors(report, "gtin") == []
+
+
+def test_csv_with_blank_gln_keeps_valid_codes():
+    df = pd.concat(read_csv_chunks(
+        "gln,name_short,name_full,registration_country,address,type\n"
+        "4006381333931,ООО А,ООО Альфа,RU,Москва,manufacturer\n"
+        ",ООО Б,ООО Бета,RU,Москва,manufacturer\n"
+    ))
+    report = pms.validate_frame("companies", df)
+    assert check_digit_errors(report, "gln") == []
+
+
+def test_invalid_check_digit_is_reported():
+    df = pd.concat(read_csv_chunks("name,gtin\nАспирин,4006381333932\nПарацетамол,\n"))
+    report = pms.validate_frame("medicines", df)
+    assert check_digit_errors(report, "gtin") == [0]
+
+
+def test_fractional_integers_are_rejected():
+    df = pd.concat(read_csv_chunks(
+        "medicine_id,location_id,operation_type,operation_date,quantity\n"
+        "1,2,Поставка,2024-01-10,5\n"
+        "1.5,2,Поставка,2024-01-10,5\n"
+        "1,2,Поставка,2024-01-10,2.5\n"
+        "1,2,Поставка,2024-01-10,5.0\n"
+    ))
+    report = pms.validate_frame("operations", df)
+    assert sorted(zip(report["row"], report["column"])) == [(1, "medicine_id"), (2, "quantity")]
+    valid = df.drop(index=report["row"].unique())
+    frame = pms.prepare_import_frame(valid, pms.IMPORT_COLUMNS["operations"])
+    assert frame["quantity"].tolist() == [5, 5]
+
+
+def test_mixed_date_formats_are_accepted():
+    df = pd.concat(read_csv_chunks(
+        "medicine_id,location_id,operation_type,operation_date,quantity\n"
+        "1,2,Поставка,2024-01-10,5\n"
+        "1,2,Поставка,2024-01-10 12:30:00,5\n"
+        "1,2,Поставка,2024-01-10T12:30:00,5\n"
+        "1,2,Поставка,не дата,5\n"
+    ))
+    report = pms.validate_frame("operations", df)
+    assert sorted(zip(report["row"], report["column"])) == [(3, "operation_date")]